@@ -1,56 +1,831 @@
 import random
 import pygame
 import sys
+import argparse
 import os
+import csv
+import json
+import time
+import functools
+import hashlib
+import heapq
+try:
+    import numpy as np
+except ImportError:
+    np = None
+import queue
+import threading
+import weakref
+from collections import OrderedDict, deque
 
 
-def load_image(name, color_key=None):
+# декодирование и масштабирование без convert(): можно вызывать из фонового потока.
+# Возвращает поверхность в обычной памяти и цветовой ключ, в формат экрана её переводит finish_image
+def decode_image(name, size=None, color_key=None):
     fullname = os.path.join('data', name)
     try:
-        image = pygame.image.load(fullname).convert()
+        loaded = pygame.image.load(fullname)
     except pygame.error as message:
         print('Cannot load image:', name)
         raise SystemExit(message)
-    image = image.convert_alpha()
+    # как convert(): альфа-канал отбрасывается, прозрачность задаёт только цветовой ключ
+    image = pygame.image.frombytes(pygame.image.tobytes(loaded, 'RGBX'), loaded.get_size(), 'RGBX')
+    if color_key == -1:
+        color_key = image.get_at((0, 0))
+    if size is None:
+        return image, color_key
+    image = pygame.transform.scale(image, size)
+    if color_key is None:
+        return image, None
+    # после масштабирования цветовой ключ превращается в настоящую прозрачность
+    image.set_colorkey(color_key)
+    result = pygame.Surface(size, pygame.SRCALPHA, 32)
+    result.blit(image, (0, 0))
+    return result, None
+
+
+def finish_image(prepared):
+    surface, color_key = prepared
+    image = surface.convert_alpha()
     if color_key is not None:
-        if color_key == -1:
-            color_key = image.get_at((0, 0))
         image.set_colorkey(color_key)
     return image
 
 
+# запечённые ассеты: уже масштабированные и нарезанные картинки лежат на диске сырыми RGBA-буферами,
+# манифест хранит время изменения исходника, и при его смене запись пересобирается
+class AssetCache:
+    def __init__(self, path):
+        self.path = path
+        self.manifest_path = os.path.join(path, 'manifest.json')
+        self.lock = threading.Lock()
+        try:
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    def file_for(self, key):
+        return os.path.join(self.path, ''.join(c if c.isalnum() or c in '._-' else '_' for c in key) + '.rgba')
+
+    def read(self, key, source):
+        entry = self.manifest.get(key)
+        if entry is None or entry['mtime'] != os.path.getmtime(os.path.join('data', source)):
+            return None
+        try:
+            with open(self.file_for(key), 'rb') as f:
+                data = f.read()
+            surface = pygame.image.frombuffer(data, entry['size'], 'RGBA')
+        except (OSError, ValueError, pygame.error):
+            return None
+        return surface, entry['colorkey']
+
+    def store(self, key, source, surface, colorkey=None):
+        try:
+            data = pygame.image.tobytes(surface, 'RGBA')
+            with self.lock:
+                os.makedirs(self.path, exist_ok=True)
+                with open(self.file_for(key), 'wb') as f:
+                    f.write(data)
+                self.manifest[key] = {'mtime': os.path.getmtime(os.path.join('data', source)),
+                                      'size': list(surface.get_size()),
+                                      'colorkey': list(colorkey) if colorkey is not None else None}
+                with open(self.manifest_path, 'w') as f:
+                    json.dump(self.manifest, f, indent=1)
+        except OSError:
+            # кэш только ускоряет запуск, без него всё грузится как раньше
+            pass
+
+    def get(self, key, source, build):
+        prepared = self.read(key, source)
+        if prepared is not None:
+            return finish_image(prepared)
+        image = build()
+        self.store(key, source, image, image.get_colorkey())
+        return image
+
+
+asset_cache = AssetCache(os.path.join('.cache', 'assets'))
+# картинки, уже загруженные в этом процессе: повторный вход в меню ничего не грузит
+scaled_images = {}
+# исходный файл для каждого листа, чтобы кэш кадров мог запечь нарезку
+sheet_sources = {}
+
+
+def scaled_key(name, size=None, color_key=None):
+    key = name if size is None else f'{name}@{size[0]}x{size[1]}'
+    if color_key is not None:
+        key += f'#key{color_key}'
+    return key
+
+
+# часть загрузки, которую можно делать в фоновом потоке: чтение из кэша или декодирование и масштабирование
+def prepare_scaled(name, size=None, color_key=None):
+    key = scaled_key(name, size, color_key)
+    prepared = asset_cache.read(key, name)
+    if prepared is None:
+        prepared = decode_image(name, size, color_key)
+        asset_cache.store(key, name, *prepared)
+    return prepared
+
+
+def finish_scaled(name, size, color_key, prepared):
+    key = scaled_key(name, size, color_key)
+    image = scaled_images.get(key)
+    if image is None:
+        image = scaled_images[key] = finish_image(prepared)
+        sheet_sources[image] = (key, name)
+    return image
+
+
+def load_scaled(name, size=None, color_key=None):
+    image = scaled_images.get(scaled_key(name, size, color_key))
+    if image is None:
+        image = finish_scaled(name, size, color_key, prepare_scaled(name, size, color_key))
+    return image
+
+
+# ассеты по требованию: images_sprites[имя] грузит картинку при первом обращении,
+# prefetch отдаёт декодирование фоновому потоку, а pump доделывает convert_alpha в основном потоке
+class AssetManager:
+    def __init__(self, specs, animations):
+        self.specs = specs
+        self.animations = animations
+        self.images = {}
+        self.requested = set()
+        self.queue = queue.Queue()
+        self.ready = queue.Queue()
+        self.cut = deque()
+        self.worker = None
+
+    def spec(self, name):
+        file, size, *color_key = self.specs[name]
+        return file, size, color_key[0] if color_key else -1
+
+    def __getitem__(self, name):
+        image = self.images.get(name)
+        if image is None:
+            image = self.images[name] = load_scaled(*self.spec(name))
+        return image
+
+    def __contains__(self, name):
+        return name in self.specs
+
+    def prefetch(self, names):
+        for name in names:
+            if name not in self.images and name not in self.requested:
+                self.requested.add(name)
+                self.queue.put(name)
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.work, daemon=True)
+            self.worker.start()
+
+    def work(self):
+        while True:
+            name = self.queue.get()
+            try:
+                self.ready.put((name, prepare_scaled(*self.spec(name))))
+            except BaseException as error:
+                # ошибка загрузки пробрасывается в основной поток при следующем pump
+                self.ready.put((name, error))
+
+    def pump(self, limit=None):
+        done = 0
+        while limit is None or done < limit:
+            if self.cut:
+                # листы нарезаются по одному за вызов, чтобы не занимать кадр целиком
+                name, columns, rows, timing = self.cut.popleft()
+                get_animation(self[name], columns, rows, timing=timing)
+            else:
+                try:
+                    name, prepared = self.ready.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(prepared, BaseException):
+                    raise prepared
+                if name not in self.images:
+                    self.images[name] = finish_scaled(*self.spec(name), prepared)
+                self.cut.extend(animation for animation in self.animations if animation[0] == name)
+            done += 1
+        return done
+
+    def busy(self):
+        return bool(self.cut) or any(name not in self.images for name in self.requested)
+
+    def progress(self, names):
+        return sum(name in self.images for name in names) / max(len(names), 1)
+
+
+# музыка: треки один раз декодируются в память (в фоновом потоке) и дальше переключаются плавным переходом
+# между каналами, без stop/load/play на каждом экране. Громкость и выключенный звук хранятся здесь же
+class MusicManager:
+    def __init__(self, volume, fade_ms=600, enabled=True):
+        self.volume = volume
+        self.fade_ms = fade_ms
+        self.enabled = enabled
+        self.muted = False
+        self.tracks = {}
+        self.pending = {}
+        self.current = None
+        self.channel = None
+
+    # микшер поднимается при первом обращении к музыке; без звуковой карты игра идёт в тишине
+    def init(self):
+        if self.enabled and not pygame.mixer.get_init():
+            try:
+                pygame.mixer.init()
+            except pygame.error as error:
+                print(f'music: no audio device: {error}')
+                self.enabled = False
+        return self.enabled
+
+    def load(self, name):
+        try:
+            self.tracks[name] = pygame.mixer.Sound(os.path.join('music', name))
+        except (pygame.error, OSError) as error:
+            # без трека игра идёт дальше, просто в тишине
+            print(f'music: cannot load {name}: {error}')
+            self.tracks[name] = None
+
+    def preload(self, names):
+        names = [name for name in names if name not in self.tracks and name not in self.pending]
+        if not names or not self.init():
+            return
+        for name in names:
+            self.pending[name] = threading.Event()
+
+        def work():
+            for name in names:
+                self.load(name)
+                self.pending[name].set()
+        threading.Thread(target=work, daemon=True).start()
+
+    def get(self, name):
+        if name in self.pending:
+            self.pending[name].wait()
+        if name not in self.tracks:
+            self.load(name)
+        return self.tracks[name]
+
+    def play(self, name):
+        if name == self.current or not self.init():
+            return
+        if self.channel is not None:
+            self.channel.fadeout(self.fade_ms)
+        self.current, self.channel = name, None
+        sound = self.get(name)
+        if sound is not None:
+            sound.set_volume(self.level())
+            self.channel = sound.play(loops=-1, fade_ms=self.fade_ms)
+
+    def level(self):
+        return 0 if self.muted else self.volume
+
+    def set_volume(self, volume):
+        self.volume = volume
+        self.apply()
+
+    def toggle_mute(self):
+        self.muted = not self.muted
+        self.apply()
+
+    def apply(self):
+        sound = self.tracks.get(self.current)
+        if sound is not None:
+            sound.set_volume(self.level())
+
+
+# замеры по фазам главного цикла: оверлей по F3 и выгрузка в CSV/JSON со скользящими перцентилями
+class Profiler:
+    def __init__(self, window=300):
+        self.enabled = False
+        self.overlay = False
+        self.window = window
+        self.samples = {}
+        self.current = {}
+        self.frame = 0
+        self.export = None
+        self.writer = None
+        self.panel = None
+        # мгновенные значения, не время (например, мегабайты поверхностей)
+        self.gauges = {}
+
+    def section(self, name):
+        if not self.enabled:
+            return NULL_SECTION
+        return ProfilerSection(self, name)
+
+    def add(self, name, ms):
+        self.current[name] = self.current.get(name, 0) + ms
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def open_export(self, path):
+        self.export = open(path, 'w', newline='')
+        if path.endswith('.csv'):
+            self.writer = csv.writer(self.export)
+            self.writer.writerow(['frame', 'phase', 'ms', 'p50', 'p99'])
+        self.enabled = True
+
+    def close_export(self):
+        if self.export:
+            self.export.close()
+            self.export = self.writer = None
+
+    def toggle_overlay(self):
+        self.overlay = not self.overlay
+        self.enabled = self.overlay or self.export is not None
+        self.panel = None
+
+    @staticmethod
+    def percentile(values, q):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * q))]
+
+    def stats(self):
+        return {name: (values[-1], self.percentile(values, 0.5), self.percentile(values, 0.99))
+                for name, values in self.samples.items()}
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        for name in self.samples:
+            self.current.setdefault(name, 0)
+        for name, ms in self.current.items():
+            self.samples.setdefault(name, deque(maxlen=self.window)).append(ms)
+        if self.export:
+            stats = self.stats()
+            if self.writer:
+                for name, (ms, p50, p99) in stats.items():
+                    self.writer.writerow([self.frame, name, f'{ms:.4f}', f'{p50:.4f}', f'{p99:.4f}'])
+                for name, value in self.gauges.items():
+                    self.writer.writerow([self.frame, name, f'{value:.4f}', '', ''])
+            else:
+                self.export.write(json.dumps({'frame': self.frame, 'phases': {
+                    name: {'ms': ms, 'p50': p50, 'p99': p99} for name, (ms, p50, p99) in stats.items()},
+                    'gauges': self.gauges}) + '\n')
+        self.current = {}
+        self.frame += 1
+        # текст оверлея перерисовывается 4 раза в секунду, а не каждый кадр
+        if self.overlay and self.frame % 15 == 0:
+            self.panel = None
+
+    def draw(self, surface):
+        if self.panel is None:
+            overlay_font = get_font('consolas', 18)
+            lines = [f'{"phase":<22}{"ms":>8}{"p50":>8}{"p99":>8}']
+            for name, (ms, p50, p99) in sorted(self.stats().items()):
+                lines.append(f'{name:<22}{ms:>8.2f}{p50:>8.2f}{p99:>8.2f}')
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f'{name:<22}{value:>8.1f}')
+            rendered = [render_text(overlay_font, line, (255, 255, 255)) for line in lines]
+            self.panel = pygame.Surface((max(r.get_width() for r in rendered) + 20,
+                                         sum(r.get_height() for r in rendered) + 20))
+            self.panel.set_alpha(200)
+            y = 10
+            for r in rendered:
+                self.panel.blit(r, (10, y))
+                y += r.get_height()
+        return surface.blit(self.panel, (10, 10))
+
+
+class ProfilerSection:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, (time.perf_counter() - self.start) * 1000)
+
+
+class NullSection:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_SECTION = NullSection()
+profiler = Profiler()
+
+
+def profiled(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profiler.section(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# группа с расписанием обновлений: за тик обходятся только спрайты, чья очередь подошла.
+# Спрайт с update_rate = N обновляется раз в N тиков, update(ticks=...) получает число прошедших тиков; спящий (sleep)
+# не обновляется вовсе, пока в notify не придёт событие одного из его типов. Рисуются и перебираются все спрайты
 class SpriteGroup(pygame.sprite.Group):
     def __init__(self):
         super().__init__()
+        self.tick = 0
+        # тик -> [(спрайт, сколько тиков прошло с прошлого обновления, update_rate на момент назначения)].
+        # due хранит действующую запись спрайта: записи убранных, уснувших и переназначенных просто пропускаются
+        self.wheel = {}
+        self.due = {}
+        # добавленные после прошлого тика обновляются в следующем, в порядке добавления
+        self.fresh = {}
+        # тип события -> спящие спрайты, которых оно будит
+        self.sleepers = {}
+        self.sleeping = {}
+        self.spread = 0
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        self.fresh[sprite] = None
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        self.due.pop(sprite, None)
+        self.fresh.pop(sprite, None)
+        self.forget_sleep(sprite)
+
+    def empty(self):
+        super().empty()
+        # разнос по тикам начинается заново: перезапуск идёт так же, как первый забег, и повторы сходятся
+        self.spread = 0
+
+    def sleep(self, sprite, event_types):
+        self.due.pop(sprite, None)
+        self.fresh.pop(sprite, None)
+        self.sleeping[sprite] = event_types
+        for event_type in event_types:
+            self.sleepers.setdefault(event_type, {})[sprite] = None
+
+    def forget_sleep(self, sprite):
+        for event_type in self.sleeping.pop(sprite, ()):
+            del self.sleepers[event_type][sprite]
+
+    def wake(self, sprite):
+        if sprite in self.sleeping:
+            self.forget_sleep(sprite)
+            self.fresh[sprite] = None
+
+    def notify(self, events):
+        for event in events:
+            for sprite in list(self.sleepers.get(event.type, ())):
+                self.wake(sprite)
+
+    def update(self, *args, **kwargs):
+        self.tick += 1
+        tick, due, wheel = self.tick, self.due, self.wheel
+        due_now = wheel.pop(tick, [])
+        for sprite in self.fresh:
+            entry = due[sprite] = (sprite, 1, 1)
+            due_now.append(entry)
+        self.fresh = {}
+        following = wheel.setdefault(tick + 1, [])
+        # при включённом профилировщике время обновления делится по классам спрайтов
+        timed = profiler.enabled
+        for entry in due_now:
+            if due.get(entry[0]) is not entry:
+                continue
+            sprite, ticks, rate = entry
+            if timed:
+                start_time = time.perf_counter()
+            if ticks == 1:
+                sprite.update(*args, **kwargs)
+            else:
+                sprite.update(*args, ticks=ticks, **kwargs)
+            if timed:
+                profiler.add('update:' + type(sprite).__name__, (time.perf_counter() - start_time) * 1000)
+            if due.get(sprite) is not entry:
+                continue
+            new_rate = getattr(sprite, 'update_rate', 1)
+            if new_rate == 1:
+                entry = due[sprite] = (sprite, 1, 1)
+                following.append(entry)
+                continue
+            delay = new_rate
+            if new_rate != rate:
+                # перешедшие на редкие обновления разносятся по разным тикам, чтобы не обновляться всем разом
+                self.spread += 1
+                delay = 1 + self.spread % new_rate
+            entry = due[sprite] = (sprite, delay, new_rate)
+            wheel.setdefault(tick + delay, []).append(entry)
 
     def get_event(self, event):
         for sprite in self:
             sprite.get_event(event)
 
 
+# общий кэш кадров: (лист, столбцы, строки, размер) -> Animation, каждый кадр масштабируется один раз.
+# Порядок - от давно не использованных к свежим, по нему вытесняются кадры при нехватке памяти
+frame_cache = OrderedDict()
+
+
+# байты пикселей поверхности; подповерхность делит пиксели с родителем и своей памяти не занимает
+def surface_bytes(surface):
+    if surface is None or surface.get_parent() is not None:
+        return 0
+    return surface.get_pitch() * surface.get_height()
+
+
+# маска - бит на пиксель
+def mask_bytes(mask):
+    w, h = mask.get_size()
+    return (w + 7) // 8 * h
+
+
+class Animation:
+    def __init__(self, frames, frame_duration):
+        self.frames = frames
+        # отражённые кадры строятся один раз, поворот спрайта - просто смена ссылки
+        self.mirrored = tuple(pygame.transform.flip(frame, True, False) for frame in frames)
+        self.masks = tuple(pygame.mask.from_surface(frame) for frame in self.frames)
+        self.mirrored_masks = tuple(pygame.mask.from_surface(frame) for frame in self.mirrored)
+        # вся область, которую анимация закрывает за цикл (нужна для ударов)
+        self.area = self.union(self.masks)
+        self.mirrored_area = self.union(self.mirrored_masks)
+        self.frame_duration = frame_duration
+        self.length = len(frames) * frame_duration
+        self.nbytes = (surface_bytes(frames[0].get_parent()) + sum(surface_bytes(frame) for frame in self.mirrored) +
+                       sum(mask_bytes(mask) for mask in self.masks + self.mirrored_masks) +
+                       mask_bytes(self.area) + mask_bytes(self.mirrored_area))
+
+    @staticmethod
+    def union(masks):
+        area = pygame.mask.Mask(masks[0].get_size())
+        for mask in masks:
+            area.draw(mask, (0, 0))
+        return area
+
+
+# timing - (столбцы, строки) листа ходьбы: как и раньше, атака играет в темпе ходьбы своего спрайта
+def get_animation(sheet, columns, rows, size=(150, 150), timing=None):
+    walk_columns, walk_rows = timing or (columns, rows)
+    frame_duration = 60 // walk_columns * walk_rows
+    key = (sheet, columns, rows, size, frame_duration)
+    animation = frame_cache.get(key)
+    if animation is not None:
+        frame_cache.move_to_end(key)
+    else:
+        def build():
+            w, h = sheet.get_width() // columns, sheet.get_height() // rows
+            strip = pygame.Surface((size[0] * columns * rows, size[1]), pygame.SRCALPHA)
+            for j in range(rows):
+                for i in range(columns):
+                    frame = sheet.subsurface(pygame.Rect((w * i, h * j), (w, h)))
+                    strip.blit(pygame.transform.scale(frame, size).convert_alpha(), ((j * columns + i) * size[0], 0))
+            return strip
+        # нарезанные кадры хранятся одной лентой, запечённой на диск, если известен исходный файл листа
+        if sheet in sheet_sources:
+            sheet_key, source = sheet_sources[sheet]
+            strip = asset_cache.get(f'{sheet_key}/{columns}x{rows}@{size[0]}x{size[1]}', source, build)
+        else:
+            strip = build()
+        frames = tuple(strip.subsurface(pygame.Rect((i * size[0], 0), size)) for i in range(columns * rows))
+        # кадр держится столько тиков, сколько раз он раньше дублировался в списке
+        animation = Animation(frames, frame_duration)
+        frame_cache[key] = animation
+    return animation
+
+
+# учёт памяти поверхностей по категориям: картинки ассетов, анимации из кэша кадров, меню, собственные
+# картинки спрайтов и экранные буферы. Каждая поверхность считается один раз - в первой категории, где встретилась.
+# budget (байты) ограничивает общий объём: при превышении вытесняются кадры монстров, которых нет
+# ни в текущей, ни в соседних комнатах, начиная с давно не использованных
+class SurfaceMemory:
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.evicted = 0
+
+    def report(self):
+        seen = set()
+
+        def own(surface):
+            if surface is None or id(surface) in seen:
+                return 0
+            seen.add(id(surface))
+            return surface_bytes(surface)
+
+        report = {'assets': {}, 'animations': {}, 'menus': {}, 'sprites': {}, 'screen': {}}
+        for name, image in images_sprites.images.items():
+            report['assets'][name] = own(image)
+        for key, image in scaled_images.items():
+            if id(image) not in seen:
+                report['assets'][key] = own(image)
+        for (sheet, columns, rows, size, _), animation in frame_cache.items():
+            name = sheet_sources[sheet][0] if sheet in sheet_sources else 'sheet'
+            report['animations'][f'{name}/{columns}x{rows}@{size[0]}x{size[1]}'] = animation.nbytes
+        for name, image in menu_backgrounds.items():
+            report['menus'][f'background:{name}'] = own(image)
+        report['menus']['buttons'] = sum(own(image) for image in menu_button_cache.values())
+        for group in (all_sprites, hud_group, button_group, menu_group, horde.views):
+            for sprite in group:
+                size = own(sprite.image)
+                if size:
+                    report['sprites'][f'{type(sprite).__name__}@{id(sprite):x}'] = size
+        for name, image in (('window', window), ('render target', screen), ('background', renderer.background),
+                            ('profiler', profiler.panel)):
+            report['screen'][name] = own(image)
+        return report
+
+    def totals(self):
+        return {category: sum(items.values()) for category, items in self.report().items()}
+
+    def total(self):
+        return sum(self.totals().values())
+
+    # листы монстров, которые нельзя вытеснять: живые монстры, текущая и соседние комнаты, активная орда
+    def protected_sheets(self):
+        names = set()
+        for room in engine.rooms[max(engine.cur_loc - 1, 0):engine.cur_loc + 2]:
+            names |= room.monster_types()
+        if horde.count:
+            names |= {kind[0] for kind in Horde.KINDS}
+        sheets = {images_sprites.images.get(f'{name}{suffix}') for name in names for suffix in ('', '_attacking')}
+        for monster in monster_group:
+            sheets |= {monster.image_walk, monster.attack_image}
+        return sheets
+
+    def enforce(self):
+        if self.budget is None:
+            return 0
+        excess = self.total() - self.budget
+        if excess <= 0:
+            return 0
+        monster_sheets = {images_sprites.images.get(f'{name}{suffix}')
+                          for name in MONSTER_SHEETS for suffix in ('', '_attacking')} - {None}
+        keep = self.protected_sheets()
+        freed = 0
+        for key in list(frame_cache):
+            if freed >= excess:
+                break
+            if key[0] in monster_sheets and key[0] not in keep:
+                freed += frame_cache.pop(key).nbytes
+                self.evicted += 1
+        # орда без монстров держит свои анимации отдельно; при следующем спавне они соберутся заново.
+        # Монстры в пуле и запасные представления орды кадров не держат (Monster.drop, Horde.retire)
+        if freed and not horde.count:
+            horde.animations = None
+        return freed
+
+
 class AnimatedSprite(pygame.sprite.Sprite):
     def __init__(self, group, sheet, columns, rows, x, y):
         super().__init__(group)
-        self.frames = []
-        self.col, self.row = columns, rows
-        self.cut_sheet(sheet, columns, rows)
+        self.flipped = False
+        self.set_animation(get_animation(sheet, columns, rows))
+        self.rect = self.image.get_rect().move(x, y)
+
+    def set_animation(self, animation, flipped=None):
+        self.animation = animation
+        if flipped is not None:
+            self.flipped = flipped
+        self.frames = animation.mirrored if self.flipped else animation.frames
+        self.masks = animation.mirrored_masks if self.flipped else animation.masks
+        self.tick = 0
         self.cur_frame = 0
         self.image = self.frames[self.cur_frame]
-        self.rect = self.rect.move(x, y)
-
-    def cut_sheet(self, sheet, columns, rows):
-        self.rect = pygame.Rect(0, 0, sheet.get_width() // columns,
-                                sheet.get_height() // rows)
-        for j in range(rows):
-            for i in range(columns):
-                frame_location = (self.rect.w * i, self.rect.h * j)
-                for _ in range(0, 60 // self.col * self.row):
-                    self.frames.append(pygame.transform.scale(sheet.subsurface(pygame.Rect(
-                        frame_location, self.rect.size)), (150, 150)).convert_alpha())
+        self.mask = self.masks[self.cur_frame]
 
-    def update(self):
-        self.cur_frame = (self.cur_frame + 1) % len(self.frames)
+    def set_flipped(self, flipped):
+        self.flipped = flipped
+        self.frames = self.animation.mirrored if flipped else self.animation.frames
+        self.masks = self.animation.mirrored_masks if flipped else self.animation.masks
         self.image = self.frames[self.cur_frame]
+        self.mask = self.masks[self.cur_frame]
+
+    def update(self, ticks=1):
+        self.tick = (self.tick + ticks) % self.animation.length
+        self.cur_frame = self.tick // self.animation.frame_duration
+        self.image = self.frames[self.cur_frame]
+        self.mask = self.masks[self.cur_frame]
+
+
+# цель отрисовки может быть меньше логического экрана 1920x1080 (--render 960x540): игра считает всё в логических
+# координатах, а картинки и прямоугольники переводятся в пиксели цели только при рисовании
+def view_point(pos):
+    if not VIEW_SCALED:
+        return pos
+    return round(pos[0] * VIEW_SCALE[0]), round(pos[1] * VIEW_SCALE[1])
+
+
+def view_rect(rect):
+    if not VIEW_SCALED:
+        return rect
+    rect = pygame.Rect(rect)
+    return pygame.Rect(view_point(rect.topleft), view_point(rect.size))
+
+
+# уменьшенные копии картинок, по одной на исходную поверхность; уходят вместе с ней (например, при вытеснении кадров)
+view_images = weakref.WeakKeyDictionary()
+
+
+def view_image(image):
+    if not VIEW_SCALED:
+        return image
+    scaled = view_images.get(image)
+    if scaled is None:
+        size = view_point(image.get_size())
+        # у картинок с цветовым ключом сглаживание дало бы кайму цвета ключа
+        if image.get_colorkey() is None:
+            scaled = pygame.transform.smoothscale(image, size)
+        else:
+            scaled = pygame.transform.scale(image, size)
+        view_images[image] = scaled
+    return scaled
+
+
+# вывод кадра: цель отрисовки растягивается на окно одним scale, без растяжения - обычный update/flip
+def present(rects=None):
+    if screen is window:
+        if rects is None:
+            pygame.display.flip()
+        else:
+            pygame.display.update(rects)
+        return
+    if SMOOTH_UPSCALE:
+        pygame.transform.smoothscale(screen, WINDOW_SIZE, window)
+    else:
+        pygame.transform.scale(screen, WINDOW_SIZE, window)
+    pygame.display.flip()
+
+
+# позиция мыши в окне -> логические координаты
+def logical_pos(pos):
+    if WINDOW_SIZE == screen_size:
+        return pos
+    return pos[0] * width // WINDOW_SIZE[0], pos[1] * height // WINDOW_SIZE[1]
+
+
+# позиция для отрисовки: между прошлым и текущим тиком, alpha - доля прошедшего шага симуляции
+def draw_rect(sprite, alpha=None):
+    rect = pygame.Rect(sprite.rect)
+    prev = getattr(sprite, 'prev_pos', None)
+    if alpha is None or prev is None:
+        return rect
+    dx, dy = rect.x - prev[0], rect.y - prev[1]
+    # переход между комнатами - телепорт, его не сглаживаем
+    if abs(dx) > MAX_INTERPOLATION or abs(dy) > MAX_INTERPOLATION:
+        return rect
+    rect.topleft = (round(prev[0] + dx * alpha), round(prev[1] + dy * alpha))
+    return rect
+
+
+# отрисовка грязными прямоугольниками: фон восстанавливается только там, где спрайт сдвинулся,
+# сменил картинку или исчез, и на экран отправляются только эти области
+class DirtyRenderer:
+    def __init__(self, background):
+        self.background = background
+        self.drawn = {}
+        self.pending = []
+        self.full = True
+
+    def invalidate(self):
+        self.full = True
+
+    # область, нарисованная поверх спрайтов (оверлей), восстанавливается в следующем кадре
+    def add_dirty(self, rect):
+        self.pending.append(pygame.Rect(rect))
+
+    # все прямоугольники внутри - в пикселях цели отрисовки
+    def draw(self, surface, *groups, alpha=None):
+        sprites = [sprite for group in groups for sprite in group]
+        drawn = {sprite: (view_image(sprite.image), view_rect(draw_rect(sprite, alpha))) for sprite in sprites}
+        if not self.full:
+            dirty = self.pending
+            dirty += [rect for sprite, (image, rect) in self.drawn.items() if drawn.get(sprite) != (image, rect)]
+            dirty += [rect for sprite, (image, rect) in drawn.items() if self.drawn.get(sprite) != (image, rect)]
+            pieces = None
+            if len(dirty) <= DIRTY_LIMIT:
+                pieces = [(image, rect, rect.collidelistall(dirty)) for image, rect in drawn.values()]
+                # когда меняется почти всё или спрайты свалены в кучу (орда), полная перерисовка дешевле
+                if sum(len(indices) for image, rect, indices in pieces) > DIRTY_LIMIT * 4:
+                    pieces = None
+            if pieces is None:
+                self.full = True
+            elif dirty:
+                for rect in dirty:
+                    surface.blit(self.background, rect, rect)
+                # перерисовываются только куски спрайтов внутри грязных областей, с сохранением порядка слоёв
+                for image, rect, indices in pieces:
+                    for index in indices:
+                        clip = rect.clip(dirty[index])
+                        surface.blit(image, clip, clip.move(-rect.x, -rect.y))
+                with profiler.section('flip'):
+                    present(dirty)
+        if self.full:
+            surface.blit(self.background, (0, 0))
+            surface.blits([(image, rect) for image, rect in drawn.values()])
+            with profiler.section('flip'):
+                present()
+            self.full = False
+        self.drawn = drawn
+        self.pending = []
 
 
 class Sprite(pygame.sprite.Sprite):
@@ -58,17 +833,50 @@ class Sprite(pygame.sprite.Sprite):
         super().__init__(group)
         self.rect = None
 
+    # не обновляться, пока не придёт событие одного из типов
+    def sleep(self, *event_types):
+        for group in self.groups():
+            if isinstance(group, SpriteGroup):
+                group.sleep(self, event_types)
 
-class Heart(Sprite):
-    def __init__(self, pos):
-        super().__init__(all_sprites)
-        self.image = images_sprites['heart']
-        self.rect = self.image.get_rect()
-        self.rect.x = pos[0]
-        self.rect.y = pos[1]
 
-    def update(self):
-        super().update()
+# полоска здоровья в правом верхнем углу: все сердца собраны в одну картинку, которая пересобирается
+# только при смене здоровья (готовые картинки хранятся по (здоровье, максимум))
+class HealthBar(Sprite):
+    def __init__(self):
+        super().__init__(hud_group)
+        self.images = {}
+        self.state = None
+        self.refresh()
+
+    def refresh(self):
+        player = engine.player
+        state = (min(max(player.health, 0), player.max_hp), player.max_hp)
+        if state == self.state:
+            return
+        self.state = state
+        image = self.images.get(state)
+        if image is None:
+            image = self.images[state] = self.compose(*state)
+        self.image = image
+        self.rect = image.get_rect(topright=(1915, 0))
+
+    @staticmethod
+    def compose(health, max_hp):
+        heart, broken = images_sprites['heart'], images_sprites['break_heart']
+        size = heart.get_width()
+        key = heart.get_colorkey()
+        if key is None:
+            image = pygame.Surface((size * max_hp, heart.get_height()), pygame.SRCALPHA).convert_alpha()
+        else:
+            # фон - цвет ключа сердец, так полоска рисуется тем же быстрым blit с ключом
+            image = pygame.Surface((size * max_hp, heart.get_height())).convert()
+            image.fill(key)
+            image.set_colorkey(key, pygame.RLEACCEL)
+        # разбиты левые сердца
+        for i in range(max_hp):
+            image.blit(broken if i < max_hp - health else heart, (i * size, 0))
+        return image
 
 
 class Button(Sprite):
@@ -84,22 +892,36 @@ class Button(Sprite):
         self.image_pressed = image_pressed
         self.image_not_pressed = image
 
+    # наведение меняется только от движения мыши: до него кнопка спит
     def update(self):
-        x, y = pygame.mouse.get_pos()
-        if self.rect.x <= x <= self.rect.x + self.width and self.rect.y <= y <= self.rect.y + self.height:
-            self.image = self.image_pressed
-            self.pressed = True
-        else:
-            self.image = self.image_not_pressed
-            self.pressed = False
+        self.hover(logical_pos(pygame.mouse.get_pos()))
+        self.sleep(pygame.MOUSEMOTION)
+
+    # возвращает True, если состояние наведения поменялось и кнопку нужно перерисовать
+    def hover(self, pos):
+        x, y = pos
+        pressed = self.rect.x <= x <= self.rect.x + self.width and self.rect.y <= y <= self.rect.y + self.height
+        if pressed == self.pressed:
+            return False
+        self.pressed = pressed
+        self.image = self.image_pressed if pressed else self.image_not_pressed
+        return True
 
 
 class Slime(AnimatedSprite):
     def __init__(self, pos, sheet, columns, rows, x, y):
         super().__init__(all_sprites, sheet, columns, rows, x, y)
+        self.walk_animation = self.animation
+        self.reset(pos)
+
+    # перезапуск игры использует того же слизня
+    def reset(self, pos):
+        self.add(all_sprites)
+        self.set_animation(self.walk_animation, False)
         self.rect = self.image.get_rect()
         self.rect.x = pos[0]
         self.rect.y = pos[1]
+        self.prev_pos = None
         self.health = 5
         self.damage = 1
         self.speed = 7
@@ -112,7 +934,13 @@ class Slime(AnimatedSprite):
 class Monster(AnimatedSprite):
     def __init__(self, pos, sheet, columns, rows, x, y, hp, attack_sheet, co_attack, r_attack):
         super().__init__(all_sprites, sheet, columns, rows, x, y)
-        self.add(monster_group)
+        self.reset(pos, sheet, columns, rows, x, y, hp, attack_sheet, co_attack, r_attack)
+
+    # повторная инициализация монстра, взятого из пула
+    def reset(self, pos, sheet, columns, rows, x, y, hp, attack_sheet, co_attack, r_attack):
+        self.add(all_sprites, monster_group)
+        self.set_animation(get_animation(sheet, columns, rows), False)
+        self.prev_pos = None
         self.image_walk = sheet
         self.attack_image = attack_sheet
         self.rect = self.image.get_rect()
@@ -126,27 +954,41 @@ class Monster(AnimatedSprite):
         self.attack = False
         self.attack_c = 0
         self.l_r = False
+        self.update_rate = 1
 
-    def update(self):
-        super().update()
-        global hearts
-        if self.rect.x > player.rect.x:
-            self.move_x = -3
-        elif self.rect.x < player.rect.x:
-            self.move_x = 3
-        if self.rect.y > player.rect.y:
-            self.move_y = -3
-        elif self.rect.y < player.rect.y:
-            self.move_y = 3
+    # ticks > 1 - монстр далеко от игрока и обновляется реже, зато шагает сразу на все пропущенные тики
+    def update(self, ticks=1):
+        super().update(ticks)
+        player = engine.player
+        direction = flow_field.direction(self.rect.center)
+        if direction is None:
+            # в клетке игрока (или если до него не дойти) - прямое преследование
+            if self.rect.x > player.rect.x:
+                self.move_x = -3
+            elif self.rect.x < player.rect.x:
+                self.move_x = 3
+            if self.rect.y > player.rect.y:
+                self.move_y = -3
+            elif self.rect.y < player.rect.y:
+                self.move_y = 3
+            step_x = self.move_x
+        else:
+            step_x, self.move_y = 3 * direction[0], 3 * direction[1]
+            if step_x:
+                self.move_x = step_x
         if self.last_move != self.move_x:
             self.l_r = not self.l_r
-            for i in range(len(self.frames)):
-                self.frames[i] = pygame.transform.flip(self.frames[i], True, False)
-        if pygame.sprite.collide_mask(self, player):
+            self.set_flipped(self.l_r)
+        if self in engine.player_contacts:
             self.attack = True
         if not self.attack:
-            self.rect.x += self.move_x
-            self.rect.y += self.move_y
+            # тело монстра, как и игрок, в стену не заходит: шаг по оси, упирающийся в стену, отменяется
+            self.rect.x += step_x * ticks
+            if walls and self.rect.collidelist(walls) != -1:
+                self.rect.x -= step_x * ticks
+            self.rect.y += self.move_y * ticks
+            if walls and self.rect.collidelist(walls) != -1:
+                self.rect.y -= self.move_y * ticks
         else:
             self.attack_c += 1
         self.last_move = self.move_x
@@ -154,428 +996,1259 @@ class Monster(AnimatedSprite):
             self.attack = False
             self.attack_c = 0
             self.update_frames()
-            if player.max_hp != player.health:
-                if player.health >= 0:
-                    try:
-                        for _ in range(player.max_hp - player.health):
-                            if _ == 0:
-                                index = -1
-                            else:
-                                index = -_
-                            hearts[index].image = images_sprites['break_heart']
-                    except Exception:
-                        pass
         elif self.attack_c == 50:
-            if pygame.sprite.collide_mask(self, player):
+            if self in engine.player_contacts:
                 player.health -= 1
             self.update_frames()
         if self.hp <= 0:
-            monster_group.remove(self)
-            all_sprites.remove(self)
+            monster_pool.release(self)
+        # атакующие и близкие к игроку монстры обновляются каждый тик: до контакта с игроком далёкому не успеть
+        dx, dy = self.rect.centerx - player.rect.centerx, self.rect.centery - player.rect.centery
+        far = not self.attack and dx * dx + dy * dy > FAR_DISTANCE * FAR_DISTANCE
+        self.update_rate = FAR_UPDATE_RATE if far else 1
 
     def damage(self, damage):
         self.hp -= damage
 
+    # монстр в пуле не держит кадры: иначе вытесненная из кэша анимация осталась бы в памяти. reset выдаст новые
+    def drop(self):
+        self.animation = self.frames = self.masks = self.image = self.mask = None
+
+    @profiled('update_frames')
     def update_frames(self):
-        rect = self.rect
-        self.frames = []
         if self.attack:
-            self.cut_sheet(self.attack_image, self.columns_attack, self.rows_attack)
-            if self.l_r:
-                for i in range(len(self.frames)):
-                    self.frames[i] = pygame.transform.flip(self.frames[i], True, False)
+            self.set_animation(get_animation(self.attack_image, self.columns_attack, self.rows_attack,
+                                             timing=(self.columns, self.rows)), self.l_r)
         else:
-            self.cut_sheet(self.image_walk, self.columns, self.rows)
-            if self.l_r:
-                for i in range(len(self.frames)):
-                    self.frames[i] = pygame.transform.flip(self.frames[i], True, False)
-        self.rect = rect
+            self.set_animation(get_animation(self.image_walk, self.columns, self.rows), self.l_r)
 
 
-class Room:
+# орда: позиции, скорости, hp, таймеры атаки и направление всех монстров лежат в массивах NumPy,
+# погоня, атаки и смерть считаются пачкой, а спрайты-представления нужны только для отрисовки
+class HordeView(pygame.sprite.Sprite):
+    def __init__(self):
+        super().__init__()
+        self.image = None
+        self.rect = pygame.Rect(0, 0, 150, 150)
+        self.prev_pos = None
+
+
+class Horde:
+    # (лист ходьбы, столбцы, строки, лист атаки, столбцы, строки)
+    KINDS = [('ratatuy', 4, 1, 'ratatuy_attacking', 4, 1),
+             ('skeleton', 4, 1, 'skeleton_attacking', 4, 1),
+             ('zombie', 4, 1, 'zombie_attacking', 5, 1)]
+    FIELDS = ['x', 'y', 'move_x', 'move_y', 'last_move', 'hp', 'attack_c', 'kind', 'anim_tick',
+              'attack', 'flipped', 'anim_attack']
+
     def __init__(self):
-        self.mobs = random.randint(3, 6)
-        self.checked = False
+        self.animations = None
+        self.size = 150
+        self.views = []
+        self.spare = []
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.retire(self.views)
+        self.views = []
+        if np is not None:
+            for field in self.FIELDS:
+                setattr(self, field, np.zeros(0, bool if field in ('attack', 'flipped', 'anim_attack') else int))
+
+    def load(self):
+        if self.animations is None:
+            self.animations = [(get_animation(images_sprites[walk], c, r),
+                                get_animation(images_sprites[attack], ca, ra, timing=(c, r)))
+                               for walk, c, r, attack, ca, ra in self.KINDS]
+            self.lengths = np.array([[walk.length, attack.length] for walk, attack in self.animations])
+            self.durations = np.array([[walk.frame_duration, attack.frame_duration]
+                                       for walk, attack in self.animations])
+
+    def spawn(self, count, rng=random):
+        self.load()
+        # случайные числа берутся из random (или генератора комнаты), чтобы прогон с тем же зерном повторялся
+        new = {field: np.zeros(count, getattr(self, field).dtype) for field in self.FIELDS}
+        new['kind'][:] = [rng.randrange(len(self.KINDS)) for _ in range(count)]
+        new['x'][:] = [rng.randint(400, 1920) for _ in range(count)]
+        new['y'][:] = [rng.randint(200, 980) for _ in range(count)]
+        new['hp'][:] = [rng.randint(1, 6) for _ in range(count)]
+        for field in self.FIELDS:
+            setattr(self, field, np.concatenate([getattr(self, field), new[field]]))
+        self.views += [self.spare.pop() if self.spare else HordeView() for _ in range(count)]
+        self.count += count
+        self.sync_views()
+
+    # представления умерших монстров переиспользуются при следующем спавне; до него они без картинки,
+    # чтобы не держать кадры, которые может вытеснить учёт памяти
+    def retire(self, views):
+        for view in views:
+            view.image = None
+        self.spare += views
+
+    def animation(self, i):
+        return self.animations[int(self.kind[i])][int(self.anim_attack[i])]
+
+    def mask(self, i):
+        animation = self.animation(i)
+        masks = animation.mirrored_masks if self.flipped[i] else animation.masks
+        return masks[self.anim_tick[i] // animation.frame_duration]
+
+    # индексы монстров, чьи прямоугольники (и маски, если передана mask) пересекаются с rect
+    def overlapping(self, rect, mask=None):
+        near = np.flatnonzero((self.x < rect.right) & (self.x + self.size > rect.left) &
+                              (self.y < rect.bottom) & (self.y + self.size > rect.top))
+        if mask is None:
+            return near
+        return np.array([i for i in near.tolist()
+                         if mask.overlap(self.mask(i), (int(self.x[i]) - rect.x, int(self.y[i]) - rect.y))], int)
+
+    # монстры, чьи прямоугольники задевают стены комнаты
+    def in_walls(self):
+        hit = np.zeros(self.count, bool)
+        for wall in walls:
+            hit |= ((self.x < wall.right) & (self.x + self.size > wall.left) &
+                    (self.y < wall.bottom) & (self.y + self.size > wall.top))
+        return hit
+
+    def damage(self, rect, mask, damage):
+        if self.count:
+            self.hp[self.overlapping(rect, mask)] -= damage
+
+    # то же, что Monster.update, но для всех монстров сразу
+    def step(self, player):
+        if not self.count:
+            return
+        self.anim_tick = (self.anim_tick + 1) % self.lengths[self.kind, self.anim_attack.astype(int)]
+        px, py = player.rect.x, player.rect.y
+        chase_x = np.where(self.x > px, -3, np.where(self.x < px, 3, self.move_x))
+        chase_y = np.where(self.y > py, -3, np.where(self.y < py, 3, self.move_y))
+        fx, fy, ok = flow_field.sample(self.x + self.size // 2, self.y + self.size // 2)
+        step_x = np.where(ok, 3 * fx, chase_x)
+        self.move_x = np.where(ok & (fx != 0), 3 * fx, np.where(ok, self.move_x, chase_x))
+        self.move_y = np.where(ok, 3 * fy, chase_y)
+        self.flipped ^= self.last_move != self.move_x
+        contact = np.zeros(self.count, bool)
+        contact[self.overlapping(player.rect, player.mask)] = True
+        self.attack |= contact
+        moving = ~self.attack
+        step_x, step_y = step_x * moving, self.move_y * moving
+        self.x += step_x
+        if walls:
+            self.x -= step_x * self.in_walls()
+        self.y += step_y
+        if walls:
+            self.y -= step_y * self.in_walls()
+        self.attack_c += self.attack
+        self.last_move = self.move_x.copy()
+        done = self.attack_c >= 80
+        strike = self.attack_c == 50
+        self.attack[done] = False
+        self.attack_c[done] = 0
+        self.anim_attack[done] = False
+        self.anim_attack[strike] = True
+        self.anim_tick[done | strike] = 0
+        player.health -= int(np.count_nonzero(strike & contact))
+        alive = self.hp > 0
+        if not alive.all():
+            for field in self.FIELDS:
+                setattr(self, field, getattr(self, field)[alive])
+            self.retire([view for view, keep in zip(self.views, alive.tolist()) if not keep])
+            self.views = [view for view, keep in zip(self.views, alive.tolist()) if keep]
+            self.count = len(self.views)
+        self.sync_views()
+
+    def sync_views(self):
+        frames = (self.anim_tick // self.durations[self.kind, self.anim_attack.astype(int)]).tolist()
+        for view, kind, anim_attack, flipped, frame, x, y in zip(
+                self.views, self.kind.tolist(), self.anim_attack.tolist(), self.flipped.tolist(), frames,
+                self.x.tolist(), self.y.tolist()):
+            animation = self.animations[kind][anim_attack]
+            view.image = (animation.mirrored if flipped else animation.frames)[frame]
+            view.prev_pos = view.rect.topleft
+            view.rect.topleft = (x, y)
+
+
+# поле направлений: один проход Дейкстры от клетки игрока, пересчёт только при смене клетки,
+# каждый монстр берёт направление из своей клетки за O(1), стены обходятся без A* на каждого
+class FlowField:
+    # (dx, dy, цена): по прямой 2, по диагонали 3
+    NEIGHBOURS = [(1, 0, 2), (-1, 0, 2), (0, 1, 2), (0, -1, 2), (1, 1, 3), (1, -1, 3), (-1, 1, 3), (-1, -1, 3)]
+
+    # клетки ближе clearance (половина спрайта) к стене проходимы, но дороги: центр монстра обходит стену
+    # с запасом, и тело в неё не упирается; через них путь идёт, только если игрок стоит у самой стены
+    TIGHT_COST = 20
+
+    def __init__(self, size, cell=60, clearance=75):
+        self.cell = cell
+        self.clearance = clearance
+        self.cols = -(-size[0] // cell)
+        self.rows = -(-size[1] // cell)
+        self.blocked = [False] * (self.cols * self.rows)
+        self.tight = [False] * (self.cols * self.rows)
+        self.target = None
+        self.dir_x = [0] * (self.cols * self.rows)
+        self.dir_y = [0] * (self.cols * self.rows)
+        self.reached = [False] * (self.cols * self.rows)
+        # связи считаются при первом set_walls или update, а не при импорте
+        self.links = None
+
+    def set_walls(self, walls):
+        cols, rows = self.cols, self.rows
+        margins = [wall.inflate(2 * self.clearance, 2 * self.clearance) for wall in walls]
+        for cy in range(rows):
+            for cx in range(cols):
+                cell = pygame.Rect(cx * self.cell, cy * self.cell, self.cell, self.cell)
+                self.blocked[cy * cols + cx] = cell.collidelist(walls) != -1
+                self.tight[cy * cols + cx] = cell.collidelist(margins) != -1
+        # связи между клетками считаются один раз на набор стен: (сосед, цена, шаг от соседа к клетке)
+        blocked, tight = self.blocked, self.tight
+        self.links = [[] for _ in range(cols * rows)]
+        for cy in range(rows):
+            for cx in range(cols):
+                if blocked[cy * cols + cx]:
+                    continue
+                for dx, dy, cost in self.NEIGHBOURS:
+                    nx, ny = cx + dx, cy + dy
+                    if not (0 <= nx < cols and 0 <= ny < rows) or blocked[ny * cols + nx]:
+                        continue
+                    # по диагонали нельзя срезать угол стены
+                    if dx and dy and (blocked[cy * cols + nx] or blocked[ny * cols + cx]):
+                        continue
+                    if tight[ny * cols + nx]:
+                        cost += self.TIGHT_COST
+                    self.links[cy * cols + cx].append((ny * cols + nx, cost, -dx, -dy))
+        self.target = None
+
+    def cell_of(self, pos):
+        cx = min(max(int(pos[0]) // self.cell, 0), self.cols - 1)
+        cy = min(max(int(pos[1]) // self.cell, 0), self.rows - 1)
+        return cy * self.cols + cx
+
+    def update(self, pos):
+        if self.links is None:
+            self.set_walls([])
+        target = self.cell_of(pos)
+        if target != self.target:
+            self.target = target
+            self.compute()
+
+    def compute(self):
+        size = self.cols * self.rows
+        links, dir_x, dir_y = self.links, self.dir_x, self.dir_y
+        dist = [None] * size
+        dist[self.target] = 0
+        heap = [(0, self.target)]
+        while heap:
+            d, index = heapq.heappop(heap)
+            if d != dist[index]:
+                continue
+            for other, cost, dx, dy in links[index]:
+                if dist[other] is None or d + cost < dist[other]:
+                    dist[other] = d + cost
+                    # направление клетки - шаг к той, из которой до неё дошли
+                    dir_x[other], dir_y[other] = dx, dy
+                    heapq.heappush(heap, (d + cost, other))
+        self.reached = [d is not None and d > 0 for d in dist]
+        if np is not None:
+            self.arrays = np.array(dir_x), np.array(dir_y), np.array(self.reached)
+
+    # None - монстр в клетке игрока или до игрока не дойти
+    def direction(self, pos):
+        index = self.cell_of(pos)
+        if not self.reached[index]:
+            return None
+        return self.dir_x[index], self.dir_y[index]
+
+    # то же для массивов координат (орда)
+    def sample(self, xs, ys):
+        cx = np.clip(xs // self.cell, 0, self.cols - 1)
+        cy = np.clip(ys // self.cell, 0, self.rows - 1)
+        index = cy * self.cols + cx
+        dir_x, dir_y, reached = self.arrays
+        return dir_x[index], dir_y[index], reached[index]
+
+
+# пул переиспользуемых спрайтов: acquire достаёт свободный экземпляр и вызывает у него reset
+# (или создаёт новый), release убирает спрайт из всех групп, отпускает его кадры (drop) и возвращает в пул
+class Pool:
+    def __init__(self, factory):
+        self.factory = factory
+        self.free = []
+
+    def acquire(self, *args):
+        if self.free:
+            obj = self.free.pop()
+            obj.reset(*args)
+            return obj
+        return self.factory(*args)
+
+    def release(self, obj):
+        obj.kill()
+        obj.drop()
+        self.free.append(obj)
+
+
+# листы монстров: имя -> (столбцы, строки ходьбы, столбцы, строки атаки)
+MONSTER_SHEETS = {'ratatuy': (4, 1, 4, 1), 'skeleton': (4, 1, 4, 1), 'zombie': (4, 1, 5, 1), 'boss': (4, 1, 6, 1)}
+
+
+def make_monster(name, pos, hp):
+    columns, rows, co_attack, r_attack = MONSTER_SHEETS[name]
+    return monster_pool.acquire(pos, images_sprites[name], columns, rows, 0, 0, hp,
+                                images_sprites[f'{name}_attacking'], co_attack, r_attack)
+
+
+# комната уровня. Состав берётся из своего генератора случайных чисел (одно зерно - одна и та же комната),
+# монстры собираются заранее, по одному за кадр, и держатся вне групп до входа игрока
+class Room:
+    def __init__(self, kind, seed):
+        self.kind = kind
+        self.seed = seed
+        self.checked = kind == 'start'
+        self.roster = None
+        self.monsters = []
+        self.walls = [pygame.Rect(rect) for rect in WALL_LAYOUT] if kind == 'walls' else []
+
+    def plan(self):
+        rng = random.Random(self.seed)
+        if self.kind == 'over':
+            return [('boss', (1920 - 500, 1080 - 300), 10)]
+        if self.kind in ('mobs', 'walls'):
+            return [(rng.choice(['ratatuy', 'skeleton', 'zombie']), self.spawn_point(rng), rng.randint(1, 6))
+                    for _ in range(rng.randint(1, 6))]
+        return []
+
+    # монстр не появляется внутри стены
+    def spawn_point(self, rng):
+        while True:
+            pos = (rng.randint(400, 1920), rng.randint(200, 980))
+            if pygame.Rect(pos, (150, 150)).collidelist(self.walls) == -1:
+                return pos
+
+    def ready(self):
+        return self.roster is not None and len(self.monsters) == len(self.roster)
+
+    def monster_types(self):
+        if self.kind == 'horde':
+            return {kind[0] for kind in Horde.KINDS}
+        return {name for name, pos, hp in self.plan()}
+
+    # один шаг подготовки; wait=False - не ждать картинок, которые ещё грузятся в фоне
+    def prepare_step(self, wait=False):
+        if self.roster is None:
+            self.roster = self.plan()
+            names = sorted({name for name, pos, hp in self.roster})
+            images_sprites.prefetch([f'{name}{suffix}' for name in names for suffix in ('', '_attacking')])
+            if self.kind == 'horde':
+                images_sprites.prefetch(MOB_ASSETS)
+            return
+        if self.ready():
+            return
+        name, pos, hp = self.roster[len(self.monsters)]
+        if not wait and images_sprites.progress([name, f'{name}_attacking']) < 1:
+            return
+        monster = make_monster(name, pos, hp)
+        monster.kill()
+        self.monsters.append(monster)
+
+    def enter(self):
+        if self.checked:
+            return
+        while not self.ready():
+            self.prepare_step(wait=True)
+        for monster in self.monsters:
+            monster.add(all_sprites, monster_group)
+        self.roster, self.monsters = [], []
+        if self.kind == 'horde':
+            spawn_horde(HORDE_SIZE, random.Random(self.seed))
+
+    # недостроенная комната при перезапуске отдаёт монстров обратно в пул
+    def discard(self):
+        for monster in self.monsters:
+            monster_pool.release(monster)
+        self.monsters = []
+
+
+# последовательность комнат: стартовая, count - 2 комнаты с мобами, по желанию стены и орда, и босс
+def generate_rooms(count, seed):
+    rng = random.Random(seed)
+    kinds = ['start'] + ['mobs'] * max(0, count - 2) + ['over']
+    if WALL_ROOM:
+        kinds.insert(-1, 'walls')
+    if HORDE_ROOM:
+        kinds.insert(-1, 'horde')
+    return [Room(kind, rng.getrandbits(32)) for kind in kinds]
+
+
+# свободное время кадра уходит на сборку следующей комнаты
+@profiled('rooms')
+def prepare_rooms():
+    rooms, cur_loc = engine.rooms, engine.cur_loc
+    if cur_loc + 1 < len(rooms) and not rooms[cur_loc + 1].ready():
+        rooms[cur_loc + 1].prepare_step()
+
+
+# стены комнаты: монстры обходят их по полю направлений, игрок сквозь них не проходит
+def set_walls(rects):
+    global walls
+    walls = [pygame.Rect(rect) for rect in rects]
+    flow_field.set_walls(walls)
+    renderer.background = game_background()
+    renderer.invalidate()
+
+
+# пиксельные проверки только для монстров, чьи прямоугольники пересекаются с игроком (collidelistall в query_hits)
+@profiled('collisions')
+def update_contacts():
+    player = engine.player
+    engine.player_contacts = set(query_hits(player.rect, player.mask))
+
+
+# все монстры под ударом за один проход: rect - прямоугольник удара, mask - его форма (необязательно)
+def query_hits(rect, mask=None, group=None):
+    monsters = list(monster_group if group is None else group)
+    hits = [monsters[i] for i in rect.collidelistall([monster.rect for monster in monsters])]
+    if mask is not None:
+        hits = [monster for monster in hits
+                if mask.overlap(monster.mask, (monster.rect.x - rect.x, monster.rect.y - rect.y))]
+    return hits
+
+
+def attack_area(sprite):
+    animation = sprite.animation
+    return sprite.rect, animation.mirrored_area if sprite.flipped else animation.area
 
 
 def terminate():
+    recorder.finish()
     pygame.quit()
     sys.exit()
 
 
-def start_screen():
-    global music_on, font
-    pygame.mixer.music.stop()
-    fon = pygame.transform.scale(load_image('start_image.png'), screen_size)
-    screen.blit(fon, (0, 0))
-    slime_rush = Sprite(start_screen_group)
-    slime_rush.image = load_image('Slime_rush.png', -1)
-    slime_rush.image = pygame.transform.scale(slime_rush.image, (1500, 500)).convert_alpha()
-    slime_rush.rect = (width // 9, height // 7)
-    button = Button(button_group_s, (width // 2.5, height // 1.5), images_sprites['not_pressed_button'],
-                    images_sprites['pressed_button'])
-    button_exit = Button(button_group_s, (width // 2.5, height // 1.2), images_sprites['not_pressed_button'],
-                         images_sprites['pressed_button'])
-    text = font.render('Начать игру', True, (255, 255, 255))
-    text2 = font.render('Выйти', True, (255, 255, 255))
-    pygame.mixer.music.load("music/Menu_music.mp3")
-    pygame.mixer.music.play(-1)
-    pygame.mixer.music.set_volume(0.04)
+# шрифты и отрисованные строки: SysFont ищет шрифт в системе, а render каждый раз растеризует текст.
+# Строки хранятся в LRU по (шрифт, текст, цвет)
+fonts = {}
+text_cache = OrderedDict()
+TEXT_CACHE_SIZE = 256
+
+
+def get_font(name, size):
+    font = fonts.get((name, size))
+    if font is None:
+        font = fonts[(name, size)] = pygame.font.SysFont(name, size)
+    return font
+
+
+def render_text(font, text, color):
+    key = (font, text, color)
+    image = text_cache.get(key)
+    if image is not None:
+        text_cache.move_to_end(key)
+        return image
+    image = text_cache[key] = font.render(text, True, color)
+    if len(text_cache) > TEXT_CACHE_SIZE:
+        text_cache.popitem(last=False)
+    return image
+
+
+# картинки кнопок меню вместе с надписью, собираются один раз: (надпись, смещение, наведена ли) -> Surface
+menu_button_cache = {}
+# собранные фоны меню: фон, заголовок и т.п. в одной картинке
+menu_backgrounds = {}
+menu_widgets = {}
+menu_group = SpriteGroup()
+
+
+def menu_button_image(button, label, offset, hover):
+    key = (label, offset, hover)
+    image = menu_button_cache.get(key)
+    if image is None:
+        image = (button.image_pressed if hover else button.image_not_pressed).copy()
+        image.blit(render_text(get_font('comicsans', 30), label, (255, 255, 255)), offset)
+        menu_button_cache[key] = image
+    return image
+
+
+def menu_background(name, layers):
+    base = menu_backgrounds.get(name)
+    if base is None:
+        base = menu_backgrounds[name] = pygame.Surface(RENDER_SIZE).convert()
+        for image, pos in layers:
+            base.blit(view_image(image), view_point(pos))
+    return base
+
+
+# меню ждёт событий в event.wait() и перерисовывает только кнопку, у которой сменилось наведение.
+# items: (имя, позиция кнопки, надпись, позиция надписи); возвращает имя нажатой кнопки
+def run_menu(base, items, escape=None):
+    buttons = []
+    for name, pos, label, label_pos in items:
+        # кнопки меню создаются один раз на позицию и переиспользуются всеми экранами
+        button = menu_widgets.get(pos)
+        if button is None:
+            button = menu_widgets[pos] = Button(menu_group, pos, images_sprites['not_pressed_button'],
+                                                images_sprites['pressed_button'])
+        buttons.append((name, button, label, (int(label_pos[0] - button.rect.x), int(label_pos[1] - button.rect.y))))
+
+    def draw_button(button, label=None, offset=None):
+        rect = view_rect(button.rect)
+        screen.blit(base, rect, rect)
+        if label is None:
+            screen.blit(view_image(button.image), rect)
+        else:
+            screen.blit(view_image(menu_button_image(button, label, offset, button.pressed)), rect)
+        return rect
+
+    mouse = logical_pos(pygame.mouse.get_pos())
+    screen.blit(base, (0, 0))
+    for name, button, label, offset in buttons:
+        button.hover(mouse)
+        draw_button(button, label, offset)
+    music = engine.music
+    music.hover(mouse)
+    draw_button(music)
+    present()
     while True:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                terminate()
-                pygame.mixer.music.stop()
-            elif event.type == pygame.MOUSEBUTTONDOWN:
-                if event.button == 1:
-                    if button.pressed:
-                        return
-                    elif music.pressed:
-                        if music_on:
-                            pygame.mixer.music.set_volume(0)
-                            music_on = False
-                        else:
-                            pygame.mixer.music.set_volume(0.04)
-                            music_on = True
-                    elif button_exit.pressed:
-                        terminate()
-        screen.blit(button.image, (width // 2.5, height // 1.5))
-        screen.blit(text, (width // 2.2, height // 1.45))
-        screen.blit(button_exit.image, (width // 2.5, height // 1.2))
-        screen.blit(text2, (width // 2.11, height // 1.17))
-        screen.blit(fon, screen_size)
-        button_group_s.update()
-        button_group.draw(screen)
-        button_group.update()
-        start_screen_group.draw(screen)
-        start_screen_group.update()
-        pygame.display.flip()
-        clock.tick(FPS)
+        # пока в фоне грузятся ассеты, меню просыпается и доделывает их, иначе спит до события
+        event = pygame.event.wait(50 if images_sprites.busy() else 0)
+        if event.type == pygame.NOEVENT:
+            images_sprites.pump(1)
+        elif event.type == pygame.QUIT:
+            terminate()
+        elif event.type == pygame.MOUSEMOTION:
+            pos = logical_pos(event.pos)
+            changed = [draw_button(button, label, offset) for name, button, label, offset in buttons
+                       if button.hover(pos)]
+            if music.hover(pos):
+                changed.append(draw_button(music))
+            if changed:
+                present(changed)
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE and escape:
+            return escape
+        elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+            for name, button, label, offset in buttons:
+                if button.pressed:
+                    return name
+            if music.pressed:
+                audio.toggle_mute()
+
+
+def start_screen():
+    audio.play(MENU_TRACK)
+    base = menu_background('start', [(images_sprites['start_image'], (0, 0)),
+                                     (images_sprites['title'], (width // 9, height // 7))])
+    choice = run_menu(base, [('start', (width // 2.5, height // 1.5), 'Начать игру', (width // 2.2, height // 1.45)),
+                             ('exit', (width // 2.5, height // 1.2), 'Выйти', (width // 2.11, height // 1.17))])
+    if choice == 'exit':
+        terminate()
 
 
 def over_screen(img):
-    global music_on
-    pygame.mixer.music.stop()
-    fon = pygame.transform.scale(load_image('map.png'), screen_size)
-    screen.blit(fon, (0, 0))
-    text = Sprite(over_screen_group)
-    text.image = pygame.transform.scale(load_image(img, -1), (500, 500)).convert_alpha()
-    text.rect = (width // 2.6, height // 7)
-    button = Button(button_group_o, (width // 2.5, height // 1.5), images_sprites['not_pressed_button'],
-                    images_sprites['pressed_button'])
-    button_exit = Button(button_group_o, (width // 2.5, height // 1.2), images_sprites['not_pressed_button'],
-                         images_sprites['pressed_button'])
-    text = font.render('Начать заново', True, (255, 255, 255))
-    text2 = font.render('Выйти', True, (255, 255, 255))
-    pygame.mixer.music.load("music/Menu_music.mp3")
-    pygame.mixer.music.play(-1)
-    pygame.mixer.music.set_volume(0.04)
-    if not music_on:
-        pygame.mixer.music.set_volume(0)
+    audio.play(MENU_TRACK)
+    base = menu_background(img, [(images_sprites['over_background'], (0, 0)),
+                                 (images_sprites[img], (width // 2.6, height // 7))])
+    choice = run_menu(base, [('restart', (width // 2.5, height // 1.5), 'Начать заново', (width // 2.23, height // 1.45)),
+                             ('exit', (width // 2.5, height // 1.2), 'Выйти', (width // 2.11, height // 1.17))])
+    if choice == 'exit':
+        terminate()
+
+
+# без NumPy орда собирается из обычных монстров
+def spawn_horde(count, rng=random):
+    if np is None:
+        spawn_mobs(count, rng)
+    else:
+        horde.spawn(count, rng)
+
+
+def room_cleared():
+    return not monster_group and not horde.count
+
+
+def spawn_mobs(count, rng=random):
+    for i in range(count):
+        mob = rng.choice(['ratatuy', 'skeleton', 'zombie'])
+        make_monster(mob, (rng.randint(400, 1920), rng.randint(200, 980)), rng.randint(1, 6))
+
+
+# статичный фон без прозрачности: карта рисуется на него один раз
+def game_background():
+    background = pygame.Surface(RENDER_SIZE).convert()
+    background.blit(view_image(images_sprites['map']), (0, 0))
+    for wall in walls:
+        background.fill((40, 40, 40), view_rect(wall))
+    return background
+
+
+def loading_screen(names):
+    images_sprites.prefetch(names)
+    loading_clock = pygame.time.Clock()
+    text = render_text(get_font('comicsans', 30), 'Загрузка...', (255, 255, 255))
+    bar = view_rect(pygame.Rect(width // 4, height // 2, width // 2, 40))
     while True:
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 terminate()
-            elif event.type == pygame.MOUSEBUTTONDOWN:
-                if event.button == 1:
-                    if button.pressed:
-                        return
-                    elif music.pressed:
-                        if music_on:
-                            pygame.mixer.music.set_volume(0)
-                            music_on = False
-                        else:
-                            pygame.mixer.music.set_volume(0.04)
-                            music_on = True
-                    elif button_exit.pressed:
-                        terminate()
-        screen.blit(button.image, (width // 2.5, height // 1.5))
-        screen.blit(text, (width // 2.23, height // 1.45))
-        screen.blit(button_exit.image, (width // 2.5, height // 1.2))
-        screen.blit(text2, (width // 2.11, height // 1.17))
-        button_group_o.update()
-        screen.blit(fon, screen_size)
-        button_group.draw(screen)
-        button_group.update()
-        over_screen_group.draw(screen)
-        over_screen_group.update()
-        pygame.display.flip()
-        clock.tick(FPS)
-
-
-# уровни(проверяется комната по счёту и есть ли с той стороны с которой находится игрок комната, растановка мобов)
-def check_level(side):
-    global cur_loc
-    if not monster_group:
-        rooms[cur_loc] = False
-    if not rooms[cur_loc]:
-        try:
-            c_loc = cur_loc
-            if side == 'right':
-                c_loc += 1
-                loc = rooms[c_loc]
-            if side == 'left':
-                c_loc -= 1
-                if c_loc >= 0:
-                    loc = rooms[c_loc]
-                else:
-                    raise IndexError
-            cur_loc = c_loc
-            if rooms[c_loc] == 'over':
-                monster = Monster((1920 - 500, 1080 - 300), images_sprites['boss'], 4, 1, 0, 0, 10,
-                                  images_sprites['boss_attacking'], 6, 1)
-            elif rooms[c_loc]:
-                for i in range(random.randint(1, 6)):
-                    mob = random.choice(['ratatuy', 'skeleton', 'zombie'])
-                    if mob == 'zombie':
-                        c, r = 5, 1
-                    else:
-                        c, r = 4, 1
-                    monster = Monster((random.randint(400, 1920), random.randint(200, 980)),
-                                      images_sprites[mob], 4, 1, 0, 0,
-                                      random.randint(1, 6), images_sprites[f'{mob}_attacking'], c, r)
-            return True
-        except IndexError:
+        images_sprites.pump()
+        progress = images_sprites.progress(names)
+        screen.fill((0, 0, 0))
+        screen.blit(text, (bar.x, bar.y - 50))
+        pygame.draw.rect(screen, (255, 255, 255), bar, 2)
+        fill = bar.inflate(-8, -8)
+        fill.w = int(fill.w * progress)
+        pygame.draw.rect(screen, (255, 255, 255), fill)
+        present()
+        if progress >= 1:
+            return
+        loading_clock.tick(FPS)
+
+
+# состояние забега: комнаты, игрок, нажатые клавиши и атака. Игру можно импортировать без окна и звука
+# (тесты, бенчмарки, бот): окно создаётся при первом start(), а step() проводит один тик по готовым событиям
+class Engine:
+    def __init__(self):
+        self.rooms = []
+        self.cur_loc = 0
+        self.player = None
+        self.health_bar = None
+        self.music = None
+        self.player_contacts = set()
+        self.right, self.left = False, False
+        self.right_w, self.left_w = False, True
+        self.up, self.down = False, False
+        self.attack, self.c_attack = True, 0
+        self.pause = False
+
+    # инициализация всех нужных переменных которые позже могут обновиться
+    def start(self):
+        init_display()
+        # группы, игрок, полоска здоровья и кнопка музыки живут всю сессию: перезапуск только сбрасывает их состояние
+        for monster in monster_group.sprites():
+            monster_pool.release(monster)
+        for room in self.rooms:
+            room.discard()
+        all_sprites.empty()
+        self.right, self.left = False, False
+        self.right_w, self.left_w = False, True
+        self.up, self.down = False, False
+        self.attack, self.pause = True, False
+        self.c_attack = 0
+        self.cur_loc = 0
+        self.player_contacts = set()
+        set_walls([])
+        if self.music is None:
+            self.music = Button(button_group, (1920 - 32, 1080 - 32), images_sprites['mute_music'],
+                                images_sprites['unmute_music'])
+
+        if self.player is None:
+            self.player = Slime((1920 // 2, 1080 // 2), images_sprites['player'], 4, 1, 0, 0)
+        else:
+            self.player.reset((1920 // 2, 1080 // 2))
+        if self.health_bar is None:
+            self.health_bar = HealthBar()
+        self.health_bar.refresh()
+
+        # зерно последовательности берётся из random, так что random.seed() повторяет все комнаты
+        self.rooms = generate_rooms(ROOM_COUNT, random.getrandbits(32))
+        horde.clear()
+
+    def move(self, side):
+        player = self.player
+        if side == 'right':
+            if self.left_w:
+                player.set_flipped(not player.flipped)
+            self.right_w, self.left_w = True, False
+            self.right, self.left = True, False
+        elif side == 'left':
+            if self.right_w:
+                player.set_flipped(not player.flipped)
+            self.right_w, self.left_w = False, True
+            self.right, self.left = False, True
+
+    # уровни(проверяется комната по счёту и есть ли с той стороны с которой находится игрок комната, растановка мобов)
+    @profiled('check_level')
+    def check_level(self, side):
+        rooms = self.rooms
+        if room_cleared():
+            rooms[self.cur_loc].checked = True
+        if not rooms[self.cur_loc].checked:
             return False
+        c_loc = self.cur_loc + 1 if side == 'right' else self.cur_loc - 1
+        if not 0 <= c_loc < len(rooms):
+            return False
+        self.cur_loc = c_loc
+        # комната обычно уже собрана в свободное время кадров, иначе достраивается здесь
+        rooms[c_loc].enter()
+        if rooms[c_loc].walls != walls:
+            set_walls(rooms[c_loc].walls)
+        surface_memory.enforce()
+        return True
+
+    # один тик игры: события, движение, обновление спрайтов. Возвращает 'quit', 'pause', 'lose', 'win' или None
+    def update(self, events):
+        player = self.player
+        status = None
+        for sprite in all_sprites:
+            sprite.prev_pos = sprite.rect.topleft
+        with profiler.section('events'):
+            for event in events:
+                if event.type == pygame.QUIT:
+                    status = 'quit'
+                if event.type == pygame.KEYDOWN:
+                    if (event.key == pygame.K_RIGHT or event.key == pygame.K_d) and not self.right:
+                        self.move('right')
+                    if (event.key == pygame.K_LEFT or event.key == pygame.K_a) and not self.left:
+                        self.move('left')
+                    if (event.key == pygame.K_UP or event.key == pygame.K_w) and not self.down:
+                        self.up, self.down = True, False
+                    if (event.key == pygame.K_DOWN or event.key == pygame.K_s) and not self.up:
+                        self.down, self.up = True, False
+                    if event.key == pygame.K_ESCAPE:
+                        self.pause = True
+                        status = status or 'pause'
+                    if event.key == pygame.K_F3:
+                        profiler.toggle_overlay()
+                if event.type == pygame.MOUSEBUTTONDOWN:
+                    if event.button == 1:
+                        if not self.attack:
+                            self.attack = True
+                            # лист атаки нарисован в другую сторону, поэтому отражается при взгляде влево
+                            player.set_animation(get_animation(images_sprites['player_attack'], 6, 1, timing=(4, 1)),
+                                                 self.left_w)
+                            for monster in query_hits(*attack_area(player)):
+                                monster.damage(player.damage)
+                            horde.damage(*attack_area(player), player.damage)
+                        if self.music.pressed:
+                            audio.toggle_mute()
+                if event.type == pygame.KEYUP:
+                    if (event.key == pygame.K_RIGHT or event.key == pygame.K_d) and not self.left:
+                        self.right = False
+                    if (event.key == pygame.K_LEFT or event.key == pygame.K_a) and not self.right:
+                        self.left = False
+                    if (event.key == pygame.K_UP or event.key == pygame.K_w) and not self.down:
+                        self.up = False
+                    if (event.key == pygame.K_DOWN or event.key == pygame.K_s) and not self.up:
+                        self.down = False
+        if status:
+            return status
+        if player.health <= 0:
+            return 'lose'
+        if self.rooms[self.cur_loc].kind == 'over' and room_cleared():
+            return 'win'
+        if self.attack:
+            self.c_attack += 1
+            if self.c_attack > 20:
+                self.c_attack = 0
+                self.attack = False
+                player.set_animation(get_animation(images_sprites['player'], 4, 1), self.right_w)
+        old_x, old_y = player.rect.topleft
+        if self.right:
+            player.rect.x += player.speed
+            if player.rect.x + 130 > width:
+                if self.check_level('right'):
+                    player.rect.x = 0
+                else:
+                    player.rect.x -= player.speed
+        elif self.left:
+            player.rect.x -= player.speed
+            if player.rect.x <= -20:
+                if self.check_level('left'):
+                    player.rect.x = width - 130
+                else:
+                    player.rect.x += player.speed
+        if player.rect.collidelist(walls) != -1:
+            player.rect.x = old_x
+        if self.up:
+            player.rect.y -= player.speed
+            if player.rect.y + 150 // 2 < 0:
+                player.rect.y += player.speed
+        elif self.down:
+            player.rect.y += player.speed
+            if player.rect.y + 150 > height:
+                player.rect.y = height - 150
+        if player.rect.collidelist(walls) != -1:
+            player.rect.y = old_y
+        button_group.notify(events)
+        button_group.update()
+        with profiler.section('flow_field'):
+            flow_field.update(player.rect.center)
+        update_contacts()
+        all_sprites.update()
+        horde.step(player)
+        self.health_bar.refresh()
 
+    # тик для тестов и инструментов: события - готовый список, пауза не открывает меню, draw - рисовать ли кадр.
+    # Первый вызов сам начинает забег; в свободное время после тика собирается следующая комната
+    def step(self, inputs=(), draw=False):
+        if self.player is None:
+            self.start()
+        status = self.update(inputs)
+        self.pause = False
+        if status in ('quit', 'lose', 'win'):
+            return status
+        if draw:
+            draw_frame()
+        prepare_rooms()
+        return status
 
-# генерация сердец в верхнем правом углу
-def generate_hearts():
-    global hearts
-    hearts = []
-    for _ in range(1, player.max_hp + 1):
-        heart = Heart((1915 - 128 * _, 0))
-        hearts.append(heart)
-
-
-def move(side):
-    global right, left
-    global right_w, left_w
-    if side == 'right':
-        if left_w:
-            for i in range(len(player.frames)):
-                player.frames[i] = pygame.transform.flip(player.frames[i], True, False)
-        right_w, left_w = True, False
-        right, left = True, False
-    elif side == 'left':
-        if right_w:
-            for i in range(len(player.frames)):
-                player.frames[i] = pygame.transform.flip(player.frames[i], True, False)
-        right_w, left_w = False, True
-        right, left = False, True
-
-
-# инициализация всех нужных переменных которые позже могут обновиться
-def start():
-    global over_screen_group, rooms, clock, button_group, heart_group, all_sprites, monster_group, music_on, right, \
-        left, right_w, left_w, up, down, attack, c_attack, cur_loc, hearts, music, player, button_group_s, \
-        button_group_o, pause, pause_group, font
-    pause_group = SpriteGroup()
-    over_screen_group = SpriteGroup()
-    clock = pygame.time.Clock()
-    button_group = SpriteGroup()
-    heart_group = SpriteGroup()
-    all_sprites = SpriteGroup()
-    monster_group = SpriteGroup()
-    button_group_s = SpriteGroup()
-    button_group_o = SpriteGroup()
-    font = pygame.font.SysFont("comicsans", 30)
-    right, left = False, False
-    right_w, left_w = False, True
-    up, down = False, False
-    attack, pause = True, False
-    c_attack = 0
-    cur_loc = 0
-    hearts = []
-    music = Button(button_group, (1920 - 32, 1080 - 32), images_sprites['mute_music'], images_sprites['unmute_music'])
-
-    player = Slime((1920 // 2, 1080 // 2), images_sprites['player'], 4, 1, 0, 0)
-    generate_hearts()
-    pygame.mixer.music.load("music/Cavern_music.mp3")
-    pygame.mixer.music.play(-1)
-    pygame.mixer.music.set_volume(0.04)
-    if not music_on:
-        pygame.mixer.music.set_volume(0)
-
-    rooms = [False, True, True, 'over']
-
-
-pygame.init()
+
+# безоконный режим (CI, бенчмарки): SDL без окна и звуковой карты. Меню в нём не показываются:
+# python Game.py --headless [--ticks N] [--seed S] - скриптовый прогон, бенчмарки и повторы ставят режим сами
+HEADLESS = bool(os.environ.get('SLIME_RUSH_HEADLESS'))
+if HEADLESS:
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+# логический экран: вся игровая математика в этих координатах
 screen_size = width, height = (1920, 1080)
-screen = pygame.display.set_mode(screen_size)
-pygame.display.set_caption('Slime Rush')
+
+# размер окна (--window 1280x720) и внутреннее разрешение отрисовки (--render 960x540, по умолчанию как у окна);
+# --smooth - сглаживание при растяжении на окно
+WINDOW_SIZE = RENDER_SIZE = screen_size
+SMOOTH_UPSCALE = False
+VIEW_SCALE = (1, 1)
+VIEW_SCALED = False
+# screen - цель отрисовки; без растяжения это само окно. Оба создаются в init_display, не при импорте
+window = screen = None
+
+
+def init_display():
+    global window, screen
+    if window is not None:
+        return
+    pygame.display.init()
+    pygame.font.init()
+    window = pygame.display.set_mode(WINDOW_SIZE)
+    screen = window if RENDER_SIZE == WINDOW_SIZE else pygame.Surface(RENDER_SIZE).convert()
+    pygame.display.set_caption('Slime Rush')
+
+
+# симуляция идёт фиксированными тиками, отрисовка ограничивается отдельно (на слабом железе FPS можно снизить)
+TICK_RATE = 60
+TICK_MS = 1000 / TICK_RATE
 FPS = 60
+MAX_FRAME_MS = 250
+INTERPOLATE = True
+MAX_INTERPOLATION = 50
+DIRTY_RENDERING = True
+MUSIC_VOLUME = 0.04
+MENU_TRACK = 'Menu_music.mp3'
+GAME_TRACK = 'Cavern_music.mp3'
+DIRTY_LIMIT = 200
+# монстры дальше FAR_DISTANCE пикселей от игрока обновляются раз в FAR_UPDATE_RATE тиков
+FAR_DISTANCE = 800
+FAR_UPDATE_RATE = 2
+# комната-орда перед боссом (python Game.py --horde), нужна NumPy
+HORDE_ROOM = False
+HORDE_SIZE = 1000
+# комната со стенами перед боссом (python Game.py --walls): две колонны, которые обходят монстры
+WALL_ROOM = False
+WALL_LAYOUT = [(660, 150, 60, 420), (1200, 510, 60, 420)]
+# длина уровня в комнатах, включая стартовую и комнату босса (python Game.py --rooms 8)
+ROOM_COUNT = 4
+# зерно всех забегов (python Game.py --seed N), None - новое на каждый забег
+RUN_SEED = None
+# как часто запись забега сохраняет хеш состояния, чтобы при повторе найти тик расхождения
+CHECKPOINT_TICKS = 600
+# бюджет памяти поверхностей в мегабайтах (python Game.py --memory-budget 64)
+MEMORY_BUDGET_MB = 128
+
+
+# настройки выше - значения по умолчанию: при импорте игра не читает командную строку. Их меняет main() по
+# аргументам или программа, импортировавшая игру (бенчмарк, бот). Размеры окна - до первого init_display
+def configure(window=None, render=None, smooth=None, rooms=None, horde=None, walls=None, memory_budget_mb=None,
+              seed=None, headless=None):
+    global WINDOW_SIZE, RENDER_SIZE, SMOOTH_UPSCALE, VIEW_SCALE, VIEW_SCALED
+    global ROOM_COUNT, HORDE_ROOM, WALL_ROOM, MEMORY_BUDGET_MB, RUN_SEED, HEADLESS
+    if headless:
+        HEADLESS = True
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+        audio.enabled = False
+    if window is not None:
+        WINDOW_SIZE = RENDER_SIZE = tuple(window)
+    if render is not None:
+        RENDER_SIZE = tuple(render)
+    if smooth is not None:
+        SMOOTH_UPSCALE = smooth
+    VIEW_SCALE = (RENDER_SIZE[0] / width, RENDER_SIZE[1] / height)
+    VIEW_SCALED = RENDER_SIZE != screen_size
+    if rooms is not None:
+        ROOM_COUNT = rooms
+    if horde is not None:
+        HORDE_ROOM = horde
+    if walls is not None:
+        WALL_ROOM = walls
+    if memory_budget_mb is not None:
+        MEMORY_BUDGET_MB = memory_budget_mb
+        surface_memory.budget = memory_budget_mb * 2 ** 20
+    if seed is not None:
+        RUN_SEED = seed
+
 
-images_sprites = {
-    'player': load_image('Slime.png', -1),
-    'skeleton': load_image('Skeleton.png', -1),
-    'zombie': load_image('Zombie.png', -1),
-    'ratatuy': load_image('ratatuy.png', -1),
-    'player_attack': load_image('slime_attack.png', -1),
-    'map': pygame.transform.scale(load_image('map.png', -1), (1920, 1080)),
-    'heart': pygame.transform.scale(load_image('heart.png', -1), (128, 128)).convert_alpha(),
-    'break_heart': pygame.transform.scale(load_image('heart_broken.png', -1), (128, 128)).convert_alpha(),
-    'not_pressed_button': pygame.transform.scale(load_image('not_pressed_button.png', -1), (384, 96)).convert_alpha(),
-    'pressed_button': pygame.transform.scale(load_image('pressed_button.png', -1), (384, 96)).convert_alpha(),
-    'boss': pygame.transform.scale(load_image('Boss_slime.png', -1), (512, 512)).convert_alpha(),
-    'boss_attacking': pygame.transform.scale(load_image('Boss_slime_attack.png', -1), (512, 512)).convert_alpha(),
-    'zombie_attacking': load_image('Zombie_attack.png', -1),
-    'skeleton_attacking': load_image('Skeleton_attack.png', -1),
-    'ratatuy_attacking': load_image('ratatuy_attack.png', -1),
-    'mute_music': load_image('music_on.png', -1),
-    'unmute_music': load_image('music_off.png', -1)
+# размер в виде 1280x720 для argparse
+def size_arg(value):
+    try:
+        w, h = value.lower().split('x')
+        return int(w), int(h)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected WIDTHxHEIGHT, got {value!r}')
+
+# имя -> (файл, размер после масштабирования или None[, цветовой ключ, по умолчанию -1])
+ASSETS = {
+    'player': ('Slime.png', None),
+    'skeleton': ('Skeleton.png', None),
+    'zombie': ('Zombie.png', None),
+    'ratatuy': ('Ratatuy.png', None),
+    'player_attack': ('Slime_attack.png', None),
+    'map': ('map.png', (1920, 1080)),
+    'heart': ('Heart.png', (128, 128)),
+    'break_heart': ('Heart_broken.png', (128, 128)),
+    'not_pressed_button': ('not_pressed_button.png', (384, 96)),
+    'pressed_button': ('pressed_button.png', (384, 96)),
+    'boss': ('Boss_slime.png', (512, 512)),
+    'boss_attacking': ('Boss_slime_attack.png', (512, 512)),
+    'zombie_attacking': ('Zombie_attack.png', None),
+    'skeleton_attacking': ('Skeleton_attack.png', None),
+    'ratatuy_attacking': ('Ratatuy_attack.png', None),
+    'mute_music': ('music_on.png', None),
+    'unmute_music': ('music_off.png', None),
+    'start_image': ('start_image.png', (1920, 1080), None),
+    'title': ('Slime_rush.png', (1500, 500)),
+    'over_background': ('map.png', (1920, 1080), None),
+    'game_over': ('Game_Over.png', (500, 500)),
+    'win': ('Win.png', (500, 500))
 }
+# листы анимаций: (имя, столбцы, строки, темп - столбцы и строки листа ходьбы или None)
+ANIMATIONS = [
+    ('player', 4, 1, None), ('player_attack', 6, 1, (4, 1)),
+    ('skeleton', 4, 1, None), ('skeleton_attacking', 4, 1, (4, 1)),
+    ('ratatuy', 4, 1, None), ('ratatuy_attacking', 4, 1, (4, 1)),
+    ('zombie', 4, 1, None), ('zombie_attacking', 5, 1, (4, 1)),
+    ('boss', 4, 1, None), ('boss_attacking', 6, 1, (4, 1)),
+]
 
-start_screen_group = SpriteGroup()
-music_on = True
-start()
-start_screen()
-pygame.mixer.music.load("music/Cavern_music.mp3")
-pygame.mixer.music.play(-1)
-pygame.mixer.music.set_volume(0.04)
-if not music_on:
-    pygame.mixer.music.set_volume(0)
-running = True
-
-while running:
-    rect = player.rect
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            running = False
-        if event.type == pygame.KEYDOWN:
-            if (event.key == pygame.K_RIGHT or event.key == pygame.K_d) and not right:
-                move('right')
-            if (event.key == pygame.K_LEFT or event.key == pygame.K_a) and not left:
-                move('left')
-            if (event.key == pygame.K_UP or event.key == pygame.K_w) and not down:
-                up, down = True, False
-            if (event.key == pygame.K_DOWN or event.key == pygame.K_s) and not up:
-                down, up = True, False
-            if event.key == pygame.K_ESCAPE:
-                pause = True
-                button = Button(pause_group, (width // 2.5, height // 1.9),
-                                images_sprites['not_pressed_button'],
-                                images_sprites['pressed_button'])
-                button_new = Button(pause_group, (width // 2.5, height // 1.6),
-                                    images_sprites['not_pressed_button'],
-                                    images_sprites['pressed_button'])
-                button_exit = Button(pause_group, (width // 2.5, height // 1.4),
-                                     images_sprites['not_pressed_button'],
-                                     images_sprites['pressed_button'])
-                text = font.render('Продолжить', True, (255, 255, 255))
-                text3 = font.render('Выйти', True, (255, 255, 255))
-                text2 = font.render('Начать заново', True, (255, 255, 255))
-                if not music_on:
-                    pygame.mixer.music.set_volume(0)
-                while pause:
-                    for event in pygame.event.get():
-                        if event.type == pygame.QUIT:
-                            terminate()
-                        if event.type == pygame.KEYDOWN:
-                            if event.key == pygame.K_ESCAPE:
-                                pause = False
-                        elif event.type == pygame.MOUSEBUTTONDOWN:
-                            if event.button == 1:
-                                if button.pressed:
-                                    pause = False
-                                elif button_new.pressed:
-                                    start()
-                                    pause = False
-                                elif music.pressed:
-                                    if music_on:
-                                        pygame.mixer.music.set_volume(0)
-                                        music_on = False
-                                    else:
-                                        pygame.mixer.music.set_volume(0.04)
-                                        music_on = True
-                                elif button_exit.pressed:
-                                    terminate()
-                    pause_group.update()
-                    screen.blit(images_sprites['map'], screen_size)
-                    for _ in all_sprites:
-                        screen.blit(_.image, _.rect)
-                    button_group.draw(screen)
-                    button_group.update()
-                    screen.blit(button.image, (width // 2.5, height // 1.9))
-                    screen.blit(text, (width // 2.23, height // 1.83))
-                    screen.blit(button_new.image, (width // 2.5, height // 1.6))
-                    screen.blit(text2, (width // 2.25, height // 1.55))
-                    screen.blit(button_exit.image, (width // 2.5, height // 1.4))
-                    screen.blit(text3, (width // 2.11, height // 1.35))
-                    pygame.display.flip()
-                    clock.tick(FPS)
-        if event.type == pygame.MOUSEBUTTONDOWN:
-            if event.button == 1:
-                if not attack:
-                    attack = True
-                    player.frames = []
-                    player.cut_sheet(images_sprites['player_attack'], 6, 1)
-                    player.rect = rect
-                    if left_w:
-                        for i in range(len(player.frames)):
-                            player.frames[i] = pygame.transform.flip(player.frames[i], True, False)
-                    for i in monster_group:
-                        for j in range(150):
-                            if i.rect.collidepoint(player.rect.x + j, player.rect.y + j):
-                                i.damage(player.damage)
-                                break
-                if music.pressed:
-                    if music_on:
-                        pygame.mixer.music.set_volume(0)
-                        music_on = False
-                    else:
-                        pygame.mixer.music.set_volume(0.04)
-                        music_on = True
-        if event.type == pygame.KEYUP:
-            if (event.key == pygame.K_RIGHT or event.key == pygame.K_d) and not left:
-                right = False
-            if (event.key == pygame.K_LEFT or event.key == pygame.K_a) and not right:
-                left = False
-            if (event.key == pygame.K_UP or event.key == pygame.K_w) and not down:
-                up = False
-            if (event.key == pygame.K_DOWN or event.key == pygame.K_s) and not up:
-                down = False
-    if player.health <= 0:
-        over_screen('Game_over.png')
-        start()
-    if rooms[cur_loc] == 'over' and not monster_group:
-        over_screen('Win.png')
-        start()
-    if attack:
-        c_attack += 1
-        if c_attack > 20:
-            c_attack = 0
-            attack = False
-            player.frames = []
-            player.cut_sheet(images_sprites['player'], 4, 1)
-            player.rect = rect
-    if right:
-        player.rect.x += player.speed
-        if player.rect.x + 130 > width:
-            if check_level('right'):
-                player.rect.x = 0
-            else:
-                player.rect.x -= player.speed
-    elif left:
-        player.rect.x -= player.speed
-        if player.rect.x <= -20:
-            if check_level('left'):
-                player.rect.x = width - 130
-            else:
-                player.rect.x += player.speed
-    if up:
-        player.rect.y -= player.speed
-        if player.rect.y + 150 // 2 < 0:
-            player.rect.y += player.speed
-    elif down:
-        player.rect.y += player.speed
-        if player.rect.y + 150 > height:
-            player.rect.y = height - 150
-    screen.blit(images_sprites['map'], (0, 0))
-    button_group.draw(screen)
-    button_group.update()
-    all_sprites.draw(screen)
-    all_sprites.update()
-    pygame.display.flip()
-    clock.tick(FPS)
-pygame.quit()
+# ассеты, без которых не показать меню, ассеты начала игры и всё остальное (босс подгружается, когда готовится его комната)
+MENU_ASSETS = ['not_pressed_button', 'pressed_button', 'mute_music', 'unmute_music', 'start_image', 'title']
+GAME_ASSETS = ['player', 'player_attack', 'map', 'heart', 'break_heart']
+MOB_ASSETS = ['skeleton', 'skeleton_attacking', 'zombie', 'zombie_attacking', 'ratatuy', 'ratatuy_attacking',
+              'over_background', 'game_over', 'win']
+
+images_sprites = AssetManager(ASSETS, ANIMATIONS)
+
+renderer = DirtyRenderer(None)
+horde = Horde()
+# без окна музыка не нужна: бенчмарки и повторы не тратят время на декодирование
+audio = MusicManager(MUSIC_VOLUME, enabled=not HEADLESS)
+surface_memory = SurfaceMemory(MEMORY_BUDGET_MB * 2 ** 20)
+flow_field = FlowField(screen_size)
+walls = []
+clock = pygame.time.Clock()
+all_sprites = SpriteGroup()
+monster_group = SpriteGroup()
+button_group = SpriteGroup()
+monster_pool = Pool(Monster)
+hud_group = SpriteGroup()
+engine = Engine()
+
+
+def pause_menu():
+    # снимок игры на момент паузы - неподвижный фон меню
+    choice = run_menu(screen.copy(), [
+        ('continue', (width // 2.5, height // 1.9), 'Продолжить', (width // 2.23, height // 1.83)),
+        ('new', (width // 2.5, height // 1.6), 'Начать заново', (width // 2.25, height // 1.55)),
+        ('exit', (width // 2.5, height // 1.4), 'Выйти', (width // 2.11, height // 1.35))], escape='continue')
+    if choice == 'new':
+        new_run()
+    elif choice == 'exit':
+        terminate()
+    engine.pause = False
+    renderer.invalidate()
+
+
+@profiled('draw')
+def draw_frame(alpha=None):
+    if DIRTY_RENDERING:
+        renderer.draw(screen, button_group, horde.views, all_sprites, hud_group, alpha=alpha)
+        if profiler.overlay:
+            rect = profiler.draw(screen)
+            present([rect])
+            renderer.add_dirty(rect)
+    else:
+        screen.blit(renderer.background, (0, 0))
+        screen.blits([(view_image(sprite.image), view_rect(draw_rect(sprite, alpha)))
+                      for group in (button_group, horde.views, all_sprites, hud_group) for sprite in group])
+        if profiler.overlay:
+            profiler.draw(screen)
+        with profiler.section('flip'):
+            present()
+
+
+def key_event(event_type, key):
+    return pygame.event.Event(event_type, key=key, mod=0, unicode='', scancode=0)
+
+
+def click_event(pos=(0, 0), button=1):
+    return pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos=pos, button=button)
+
+
+# скриптовый ввод для безоконного режима: {тик: [события]} вместо pygame.event.get()
+class ScriptedInput:
+    def __init__(self, script=None):
+        self.script = script if script is not None else {}
+        self.tick = 0
+
+    def add(self, tick, event):
+        self.script.setdefault(tick, []).append(event)
+
+    def get(self):
+        events = self.script.get(self.tick, [])
+        self.tick += 1
+        return events
+
+
+# прогон без окна и без ограничения кадров; пауза в этом режиме игнорируется.
+# checkpoints - словарь, куда складываются хеши состояния каждые CHECKPOINT_TICKS тиков
+def simulate(source, ticks, seed=None, draw=True, checkpoints=None):
+    random.seed(seed)
+    engine.start()
+    for tick in range(1, ticks + 1):
+        status = engine.step(source.get(), draw)
+        if checkpoints is not None and tick % CHECKPOINT_TICKS == 0:
+            checkpoints[str(tick)] = state_hash()
+        if status in ('quit', 'lose', 'win'):
+            return status
+
+
+# хеш всего, что определяет исход забега: здоровье и позиция игрока, комната, hp и позиции монстров
+def state_hash():
+    player = engine.player
+    state = [player.health, engine.cur_loc, list(player.rect.topleft),
+             [[monster.hp, monster.rect.x, monster.rect.y] for monster in monster_group]]
+    if horde.count:
+        state.append([horde.hp.tolist(), horde.x.tolist(), horde.y.tolist()])
+    return hashlib.sha1(json.dumps(state).encode()).hexdigest()[:16]
+
+
+# в записи хранится только ввод, влияющий на игру: клавиши движения и паузы, клики атаки и выход
+RECORDED_KEYS = {pygame.K_RIGHT, pygame.K_d, pygame.K_LEFT, pygame.K_a, pygame.K_UP, pygame.K_w,
+                 pygame.K_DOWN, pygame.K_s, pygame.K_ESCAPE}
+
+
+def encode_event(event):
+    if event.type == pygame.KEYDOWN and event.key in RECORDED_KEYS:
+        return ['d', event.key]
+    if event.type == pygame.KEYUP and event.key in RECORDED_KEYS:
+        return ['u', event.key]
+    if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+        return ['c'] + list(event.pos)
+    if event.type == pygame.QUIT:
+        return ['q']
+    return None
+
+
+def decode_event(kind, args):
+    if kind == 'd':
+        return key_event(pygame.KEYDOWN, args[0])
+    if kind == 'u':
+        return key_event(pygame.KEYUP, args[0])
+    if kind == 'c':
+        return click_event(tuple(args))
+    return pygame.event.Event(pygame.QUIT)
+
+
+# запись забегов (python Game.py --record runs.jsonl): одна строка JSON на забег - зерно, настройки уровня,
+# события [тик, вид, ...], промежуточные хеши состояния и итоговый хеш
+class Recorder:
+    def __init__(self):
+        self.path = None
+        self.run = None
+        self.tick = 0
+
+    def begin(self, seed):
+        self.finish()
+        if self.path is not None:
+            self.run = {'seed': seed, 'rooms': ROOM_COUNT, 'horde': HORDE_ROOM, 'walls': WALL_ROOM,
+                        'far': [FAR_DISTANCE, FAR_UPDATE_RATE], 'events': [], 'checkpoints': {}}
+            self.tick = 0
+
+    # вызывается после каждого тика с событиями, которые этот тик обработал
+    def record(self, events):
+        if self.run is None:
+            return
+        self.tick += 1
+        for event in events:
+            entry = encode_event(event)
+            if entry is not None:
+                self.run['events'].append([self.tick] + entry)
+        if self.tick % CHECKPOINT_TICKS == 0:
+            self.run['checkpoints'][str(self.tick)] = state_hash()
+
+    def finish(self):
+        if self.run is None:
+            return
+        self.run['ticks'] = self.tick
+        self.run['hash'] = state_hash()
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(self.run, separators=(',', ':')) + '\n')
+        self.run = None
+
+
+recorder = Recorder()
+
+
+# новый забег со своим зерном: с --seed N все забеги повторяют один и тот же уровень
+def new_run():
+    recorder.finish()
+    seed = RUN_SEED if RUN_SEED is not None else random.getrandbits(32)
+    random.seed(seed)
+    engine.start()
+    recorder.begin(seed)
+
+
+# повтор записанного забега без окна и на максимальной скорости (python Game.py --replay runs.jsonl [--run N]);
+# возвращает True, если все хеши состояния совпали с записью
+def replay(path, index=-1, draw=False):
+    global FAR_DISTANCE, FAR_UPDATE_RATE
+    with open(path) as f:
+        run = [json.loads(line) for line in f if line.strip()][index]
+    # в записях до появления комнаты со стенами её нет
+    configure(rooms=run['rooms'], horde=run['horde'], walls=run.get('walls', False))
+    # записи до появления редких обновлений шли с обновлением всех монстров каждый тик
+    FAR_DISTANCE, FAR_UPDATE_RATE = run.get('far', (FAR_DISTANCE, 1))
+    source = ScriptedInput()
+    for tick, kind, *args in run['events']:
+        # в записи тики считаются с единицы, ScriptedInput - с нуля
+        source.add(tick - 1, decode_event(kind, args))
+    checkpoints = {}
+    t0 = time.perf_counter()
+    status = simulate(source, run['ticks'], run['seed'], draw, checkpoints)
+    elapsed = time.perf_counter() - t0
+    print(f'replayed {run["ticks"]} ticks in {elapsed:.2f} s ({run["ticks"] / max(elapsed, 1e-9):.0f} ticks/s), '
+          f'status: {status}')
+    for tick, expected in run['checkpoints'].items():
+        if checkpoints.get(tick) != expected:
+            print(f'state diverged by tick {tick}: expected {expected}, got {checkpoints.get(tick)}')
+            return False
+    final = state_hash()
+    if final != run['hash']:
+        print(f'final state differs: expected {run["hash"]}, got {final}')
+        return False
+    print(f'final state matches: {final}')
+    return True
+
+
+# прогон без окна для CI: игрок идёт вправо по комнатам и бьёт каждые 20 тиков, кадры рисуются в фиктивный экран
+def headless_run(ticks=TICK_RATE * 10, seed=0):
+    source = ScriptedInput()
+    source.add(0, key_event(pygame.KEYDOWN, pygame.K_d))
+    for tick in range(0, ticks, 20):
+        source.add(tick, click_event())
+    t0 = time.perf_counter()
+    status = simulate(source, ticks, seed)
+    elapsed = time.perf_counter() - t0
+    print(f'simulated up to {ticks} ticks in {elapsed:.2f} s, status: {status or "running"}, state: {state_hash()}')
+
+
+# заранее запекает все картинки, нарезки листов и фоны меню в кэш (python Game.py --bake)
+def bake_assets():
+    init_display()
+    for name in ASSETS:
+        images_sprites[name]
+    for name, columns, rows, timing in ANIMATIONS:
+        get_animation(images_sprites[name], columns, rows, timing=timing)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Slime Rush')
+    parser.add_argument('--window', type=size_arg, metavar='WxH', help='window size (default: 1920x1080)')
+    parser.add_argument('--render', type=size_arg, metavar='WxH',
+                        help='internal render resolution, stretched to the window (default: window size)')
+    parser.add_argument('--smooth', action='store_true', help='smooth upscaling of the render target')
+    parser.add_argument('--rooms', type=int, help=f'rooms in a level, start and boss included (default: {ROOM_COUNT})')
+    parser.add_argument('--horde', action='store_true', help='add the horde room before the boss (needs NumPy)')
+    parser.add_argument('--walls', action='store_true', help='add the room with walls before the boss')
+    parser.add_argument('--memory-budget', type=int, metavar='MB',
+                        help=f'surface memory budget (default: {MEMORY_BUDGET_MB})')
+    parser.add_argument('--seed', type=int, help='seed of every run (default: a new one per run, 0 with --headless)')
+    parser.add_argument('--headless', action='store_true', help='scripted run without a window or sound')
+    parser.add_argument('--ticks', type=int, default=TICK_RATE * 10, help='length of the --headless run')
+    parser.add_argument('--record', metavar='FILE', help='append every run to this JSON lines file')
+    parser.add_argument('--replay', metavar='FILE', help='replay a recorded run without a window and check it')
+    parser.add_argument('--run', type=int, default=-1, help='which run of the --replay file (default: the last)')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='export per-frame profiler timings to this file (CSV for .csv, JSON lines otherwise)')
+    parser.add_argument('--bake', action='store_true', help='bake all images and animations into the cache and exit')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    configure(window=args.window, render=args.render, smooth=args.smooth, rooms=args.rooms, horde=args.horde,
+              walls=args.walls, memory_budget_mb=args.memory_budget, seed=args.seed,
+              headless=args.headless or args.replay is not None)
+    if args.bake:
+        bake_assets()
+        return
+    if args.replay is not None:
+        matched = replay(args.replay, args.run)
+        pygame.quit()
+        sys.exit(0 if matched else 1)
+    if HEADLESS:
+        headless_run(args.ticks, args.seed or 0)
+        pygame.quit()
+        return
+    recorder.path = args.record
+    init_display()
+    # меню появляется сразу, мобы и музыка догружаются в фоне, пока игрок в меню и первой комнате
+    audio.preload([MENU_TRACK, GAME_TRACK])
+    loading_screen(MENU_ASSETS + GAME_ASSETS)
+    images_sprites.prefetch(MOB_ASSETS)
+    new_run()
+    start_screen()
+    audio.play(GAME_TRACK)
+    if args.profile:
+        profiler.open_export(args.profile)
+    running = True
+    accumulator = 0
+    events = []
+    clock.tick()
+    while running:
+        # накопитель: за кадр выполняется столько тиков, сколько их прошло по реальному времени
+        accumulator += min(clock.tick(FPS), MAX_FRAME_MS)
+        with profiler.section('events'):
+            events += pygame.event.get()
+        while running and accumulator >= TICK_MS:
+            accumulator -= TICK_MS
+            status = engine.update(events)
+            recorder.record(events)
+            events = []
+            if status == 'quit':
+                running = False
+            elif status in ('pause', 'lose', 'win'):
+                if status == 'pause':
+                    pause_menu()
+                else:
+                    over_screen('game_over' if status == 'lose' else 'win')
+                    new_run()
+                    audio.play(GAME_TRACK)
+                # время, проведённое в меню, не должно догоняться тиками
+                accumulator = 0
+                clock.tick()
+        if running:
+            draw_frame(accumulator / TICK_MS if INTERPOLATE else None)
+            # память поверхностей (МБ) пересчитывается раз в полсекунды, обход всех кэшей не бесплатный
+            if profiler.enabled and profiler.frame % 30 == 0:
+                for category, size in surface_memory.totals().items():
+                    profiler.gauge(f'memory:{category}', size / 2 ** 20)
+            profiler.end_frame()
+            images_sprites.pump(1)
+            prepare_rooms()
+    recorder.finish()
+    profiler.close_export()
+    pygame.quit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+# игры идут без окна и звука, поэтому режим надо включить до импорта игры
+os.environ['SLIME_RUSH_HEADLESS'] = '1'
+
+import pygame  # noqa: E402
+import Game  # noqa: E402
+
+percentile = Game.Profiler.percentile
+
+
+def sign(value, dead_zone):
+    if value > dead_zone:
+        return 1
+    if value < -dead_zone:
+        return -1
+    return 0
+
+
+# бот вместо игрока: идёт к ближайшему монстру, бьёт, когда тот в зоне удара, а в зачищенной
+# комнате уходит вправо. Заодно считает, сколько тиков и здоровья ушло на каждую комнату
+class Bot:
+    KEYS = {'right': pygame.K_d, 'left': pygame.K_a, 'up': pygame.K_w, 'down': pygame.K_s}
+
+    def __init__(self):
+        self.tick = 0
+        self.held = set()
+        self.room = None
+        self.entered = 0
+        self.health = 0
+        self.cleared = False
+        self.rooms = []
+
+    def observe(self):
+        if Game.engine.cur_loc != self.room:
+            self.room = Game.engine.cur_loc
+            self.entered = self.tick
+            self.health = Game.engine.player.health
+            self.cleared = Game.engine.rooms[self.room].checked
+        if not self.cleared and Game.room_cleared():
+            self.cleared = True
+            self.rooms.append({'room': self.room, 'kind': Game.engine.rooms[self.room].kind,
+                               'ticks': self.tick - self.entered, 'damage': self.health - Game.engine.player.health})
+
+    def nearest(self):
+        x, y = Game.engine.player.rect.center
+        targets = [monster.rect.center for monster in Game.monster_group]
+        if Game.horde.count:
+            half = Game.horde.size // 2
+            targets += zip((Game.horde.x + half).tolist(), (Game.horde.y + half).tolist())
+        return min(targets, key=lambda target: (target[0] - x) ** 2 + (target[1] - y) ** 2, default=None)
+
+    def in_reach(self):
+        area = Game.attack_area(Game.engine.player)
+        return bool(Game.query_hits(*area)) or bool(Game.horde.count and len(Game.horde.overlapping(*area)))
+
+    # упёрся в стену по ходу движения - обходит её с той стороны, где проход шире
+    def detour(self, dx):
+        index = Game.engine.player.rect.move(dx * 20, 0).collidelist(Game.walls)
+        if index == -1:
+            return 0
+        wall = Game.walls[index]
+        return -1 if wall.top > Game.height - wall.bottom else 1
+
+    def keys(self, dx, dy):
+        want = set()
+        if dx:
+            want.add(self.KEYS['right' if dx > 0 else 'left'])
+        if dy:
+            want.add(self.KEYS['down' if dy > 0 else 'up'])
+        events = [Game.key_event(pygame.KEYUP, key) for key in self.held - want]
+        events += [Game.key_event(pygame.KEYDOWN, key) for key in want - self.held]
+        self.held = want
+        return events
+
+    def get(self):
+        self.observe()
+        events = []
+        target = self.nearest()
+        if target is None:
+            dx, dy = 1, 0
+        else:
+            dx = sign(target[0] - Game.engine.player.rect.centerx, 40)
+            dy = sign(target[1] - Game.engine.player.rect.centery, 20)
+            if not Game.engine.attack and self.in_reach():
+                events.append(Game.click_event())
+        if dx:
+            dy = self.detour(dx) or dy
+        events += self.keys(dx, dy)
+        self.tick += 1
+        return events
+
+
+def play(job):
+    seed, rooms, walls, max_ticks = job
+    Game.configure(rooms=rooms, walls=walls)
+    bot = Bot()
+    status = Game.simulate(bot, max_ticks, seed, draw=False)
+    bot.observe()
+    return {
+        'seed': seed,
+        'result': status if status in ('win', 'lose') else 'timeout',
+        'ticks': bot.tick,
+        'damage': Game.engine.player.max_hp - max(Game.engine.player.health, 0),
+        'rooms': bot.rooms,
+    }
+
+
+def aggregate(games):
+    report = {'games': len(games)}
+    for result in ('win', 'lose', 'timeout'):
+        report[result] = sum(game['result'] == result for game in games)
+    report['win_rate'] = report['win'] / len(games)
+    report['ticks_mean'] = sum(game['ticks'] for game in games) / len(games)
+    report['damage_mean'] = sum(game['damage'] for game in games) / len(games)
+    rooms = {}
+    for game in games:
+        for room in game['rooms']:
+            rooms.setdefault((room['room'], room['kind']), []).append(room)
+    report['rooms'] = []
+    for (index, kind), cleared in sorted(rooms.items()):
+        ticks = [room['ticks'] for room in cleared]
+        report['rooms'].append({
+            'room': index,
+            'kind': kind,
+            'cleared': len(cleared),
+            'ticks_p50': percentile(ticks, 0.5),
+            'ticks_p90': percentile(ticks, 0.9),
+            'damage_mean': sum(room['damage'] for room in cleared) / len(cleared),
+        })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Slime Rush batch simulation with a bot player')
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='worker processes (default: all cores)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first game, the rest follow it')
+    parser.add_argument('--rooms', type=int, default=Game.ROOM_COUNT)
+    parser.add_argument('--walls', action='store_true', help='add the room with walls before the boss')
+    parser.add_argument('--max-ticks', type=int, default=Game.TICK_RATE * 60 * 5)
+    parser.add_argument('--json', help='also write the report and per-game stats to this JSON file')
+    args = parser.parse_args()
+
+    # кэш картинок запекается один раз здесь, чтобы процессы не писали его одновременно
+    Game.bake_assets()
+    jobs = [(args.seed + i, args.rooms, args.walls, args.max_ticks) for i in range(args.games)]
+    t0 = time.perf_counter()
+    # spawn: у каждого процесса свой pygame, без копии окна и потока загрузки родителя
+    with multiprocessing.get_context('spawn').Pool(args.jobs) as pool:
+        games = sorted(pool.imap_unordered(play, jobs, chunksize=max(1, args.games // (args.jobs * 4))),
+                       key=lambda game: game['seed'])
+        # SDL перехватывает SIGTERM, поэтому процессы надо отпустить штатно, а не через terminate()
+        pool.close()
+        pool.join()
+    elapsed = time.perf_counter() - t0
+    report = aggregate(games)
+
+    print(f'{report["games"]} games in {elapsed:.1f} s on {args.jobs} processes '
+          f'({report["games"] / elapsed:.1f} games/s)')
+    print(f'win {report["win"]}  lose {report["lose"]}  timeout {report["timeout"]}  '
+          f'win rate {report["win_rate"]:.1%}')
+    print(f'ticks per game {report["ticks_mean"]:.0f}, damage taken {report["damage_mean"]:.2f}')
+    print(f'{"room":<5} {"kind":<6} {"cleared":>8} {"ticks p50/p90":>14} {"damage":>7}')
+    for room in report['rooms']:
+        print(f'{room["room"]:<5} {room["kind"]:<6} {room["cleared"]:>8} '
+              f'{room["ticks_p50"]:>6}/{room["ticks_p90"]:<7} {room["damage_mean"]:>7.2f}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'report': report, 'games': games}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
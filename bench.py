@@ -0,0 +1,173 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+# бенчмарк идёт без окна и звука, поэтому режим надо включить до импорта игры
+os.environ['SLIME_RUSH_HEADLESS'] = '1'
+
+import pygame  # noqa: E402
+import Game  # noqa: E402
+
+percentile = Game.Profiler.percentile
+
+
+# игрок бродит влево-вправо и вверх-вниз и бьёт каждые полсекунды
+def wander_script(ticks):
+    source = Game.ScriptedInput()
+    keys = [pygame.K_d, pygame.K_s, pygame.K_a, pygame.K_w]
+    for tick in range(0, ticks, 40):
+        key = keys[tick // 40 % len(keys)]
+        source.add(tick, Game.key_event(pygame.KEYDOWN, key))
+        source.add(tick + 30, Game.key_event(pygame.KEYUP, key))
+    for tick in range(0, ticks, 30):
+        source.add(tick, Game.click_event())
+    return source
+
+
+def empty_room():
+    pass
+
+
+def mobs(count):
+    def setup():
+        Game.spawn_mobs(count)
+    return setup
+
+
+def horde(count):
+    def setup():
+        Game.spawn_horde(count)
+    return setup
+
+
+def boss_room():
+    Game.engine.rooms[1] = Game.Room('over', 0)
+    Game.engine.check_level('right')
+
+
+SCENARIOS = {
+    'empty': empty_room,
+    'mobs_6': mobs(6),
+    'mobs_50': mobs(50),
+    'boss': boss_room,
+}
+if Game.np is not None:
+    SCENARIOS['horde_500'] = horde(500)
+    SCENARIOS['horde_2000'] = horde(2000)
+
+
+# импорт и первый кадр меряются в чистом процессе: в этом игра уже импортирована и окно открыто.
+# Настройки игры (размеры окна и отрисовки) приходят первым аргументом в JSON
+STARTUP_PROBE = '''
+import json
+import sys
+import time
+t0 = time.perf_counter()
+import pygame
+t1 = time.perf_counter()
+import Game
+t2 = time.perf_counter()
+Game.configure(**json.loads(sys.argv[1]))
+Game.engine.step(draw=True)
+t3 = time.perf_counter()
+print((t1 - t0) * 1000, (t2 - t1) * 1000, (t3 - t0) * 1000)
+'''
+
+
+def measure_startup(runs, settings):
+    env = dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT='1')
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', STARTUP_PROBE, json.dumps(settings)], capture_output=True,
+                             text=True, check=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        samples.append([float(value) for value in out.split()[-3:]])
+    pygame_ms, import_ms, first_frame_ms = zip(*samples)
+    return {
+        'runs': runs,
+        'pygame_p50': percentile(pygame_ms, 0.5),
+        'import_p50': percentile(import_ms, 0.5),
+        'first_frame_p50': percentile(first_frame_ms, 0.5),
+        'first_frame_max': max(first_frame_ms),
+    }
+
+
+def run_scenario(name, ticks, warmup, seed):
+    random.seed(seed)
+    Game.engine.start()
+    SCENARIOS[name]()
+    # в бенчмарке игрок не умирает, иначе сцена закончится раньше времени
+    Game.engine.player.health = 10 ** 9
+    source = wander_script(ticks + warmup)
+    update_times, draw_times = [], []
+    for tick in range(ticks + warmup):
+        events = source.get()
+        t0 = time.perf_counter()
+        Game.engine.update(events)
+        t1 = time.perf_counter()
+        Game.draw_frame()
+        t2 = time.perf_counter()
+        Game.engine.pause = False
+        if tick >= warmup:
+            update_times.append((t1 - t0) * 1000)
+            draw_times.append((t2 - t1) * 1000)
+    frame_times = [u + d for u, d in zip(update_times, draw_times)]
+    return {
+        'scenario': name,
+        'ticks': ticks,
+        'update_p50': percentile(update_times, 0.5),
+        'update_p99': percentile(update_times, 0.99),
+        'draw_p50': percentile(draw_times, 0.5),
+        'draw_p99': percentile(draw_times, 0.99),
+        'frame_p50': percentile(frame_times, 0.5),
+        'frame_p99': percentile(frame_times, 0.99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Slime Rush frame-time benchmark')
+    parser.add_argument('scenarios', nargs='*', help=f'scenarios to run: {", ".join(SCENARIOS)} (default: all)')
+    parser.add_argument('--ticks', type=int, default=600)
+    parser.add_argument('--warmup', type=int, default=60)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--startup', type=int, default=0, metavar='RUNS',
+                        help='also measure import time and time to the first frame over RUNS fresh processes '
+                             '(alone, without scenarios, only this is measured)')
+    parser.add_argument('--json', help='also write results to this JSON file')
+    parser.add_argument('--window', type=Game.size_arg, metavar='WxH', help='window size (default: 1920x1080)')
+    parser.add_argument('--render', type=Game.size_arg, metavar='WxH',
+                        help='internal render resolution, stretched to the window (default: window size)')
+    parser.add_argument('--smooth', action='store_true', help='smooth upscaling of the render target')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'unknown scenario: {name}')
+    # те же настройки получают и сцены здесь, и чистые процессы замера запуска
+    settings = {'window': args.window, 'render': args.render, 'smooth': args.smooth}
+    Game.configure(**settings)
+
+    names = args.scenarios or ([] if args.startup else list(SCENARIOS))
+    print(f'window {"x".join(map(str, Game.WINDOW_SIZE))}, render {"x".join(map(str, Game.RENDER_SIZE))}'
+          f'{", smooth" if Game.SMOOTH_UPSCALE else ""}')
+    results = [run_scenario(name, args.ticks, args.warmup, args.seed) for name in names]
+    if results:
+        print(f'{"scenario":<10} {"update p50/p99":>16} {"draw p50/p99":>16} {"frame p50/p99":>16}  (ms)')
+    for r in results:
+        print(f'{r["scenario"]:<10} {r["update_p50"]:>7.3f}/{r["update_p99"]:<8.3f} '
+              f'{r["draw_p50"]:>7.3f}/{r["draw_p99"]:<8.3f} {r["frame_p50"]:>7.3f}/{r["frame_p99"]:<8.3f}')
+    if args.startup:
+        startup = measure_startup(args.startup, settings)
+        print(f'startup over {startup["runs"]} runs (ms, p50): import pygame {startup["pygame_p50"]:.1f}, '
+              f'import Game {startup["import_p50"]:.1f}, first frame {startup["first_frame_p50"]:.1f} '
+              f'(max {startup["first_frame_max"]:.1f})')
+        results.append(dict(startup, scenario='startup'))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()